@@ -1,8 +1,13 @@
 from __future__ import absolute_import
 
+import calendar
 import logging
-from json import dumps
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import wraps
 from shutil import rmtree
+from time import monotonic, time
 
 from celery import shared_task
 from celery.utils.log import get_task_logger
@@ -16,6 +21,72 @@ from six.moves import configparser
 
 logger = get_task_logger(__name__)
 
+# Kubeconfig credentials (such as EKS tokens) expire after 15 minutes,
+# so the cached client is recreated well before that
+API_CLIENT_MAX_AGE = 10 * 60
+
+# Number of pod logs read concurrently by get_kube_logs
+LOG_WORKERS = 8
+
+# Seconds of log requested before a log cursor, allowing for clock skew
+LOG_CLOCK_MARGIN = 10
+
+# Label with the phase of an Argo workflow
+ARGO_PHASE_LABEL = "workflows.argoproj.io/phase"
+
+# Number of workflows per request by get_argo_workflows
+WORKFLOW_PAGE_SIZE = 500
+
+# Only request the metadata of workflows, which includes their phase label,
+# but fall back to full workflows if the cluster does not support it
+WORKFLOW_METADATA_ACCEPT = (
+    "application/json;as=PartialObjectMetadataList;g=meta.k8s.io;v=v1,"
+    "application/json"
+)
+
+# (pid, client, creation time) of the kubernetes ApiClient of this process
+_api_client = None
+
+
+def api_client():
+    """
+    Return the kubernetes ApiClient of this worker process, so the kubeconfig
+    is read and the connection pool is created once instead of per task.
+    A forked process or an outdated client gets a new one.
+    """
+    global _api_client
+    pid = os.getpid()
+    if (
+        _api_client is None
+        or _api_client[0] != pid
+        or monotonic() - _api_client[2] > API_CLIENT_MAX_AGE
+    ):
+        _api_client = (pid, config.new_client_from_config(), monotonic())
+    return _api_client[1]
+
+
+def reset_api_client():
+    """Forget the cached ApiClient, the next task reads the kubeconfig again."""
+    global _api_client
+    _api_client = None
+
+
+def refresh_on_unauthorized(task):
+    """Run task again with a new ApiClient if the credentials were rejected."""
+
+    @wraps(task)
+    def wrapper(*args, **kwargs):
+        try:
+            return task(*args, **kwargs)
+        except ApiException as e:
+            if e.status != 401:
+                raise
+            logger.info("Kubernetes credentials expired, reloading kubeconfig.")
+            reset_api_client()
+            return task(*args, **kwargs)
+
+    return wrapper
+
 
 @shared_task(bind=True, base=QueueOnce, once={"graceful": True, "timeout": 60})
 def delft3dgt_kube_pulse(self):
@@ -34,29 +105,52 @@ def delft3dgt_kube_pulse(self):
     once={"graceful": True, "timeout": 60},
     throws=(HTTPError),
 )
-def get_argo_workflows(self):
-    """
-    Retrieve all running argo workflows and return them in
-    an array of dictionaries.
-    """
-    client_api = config.new_client_from_config()
-    wf = client_api.call_api(
-        "/apis/argoproj.io/v1alpha1/workflows",
-        "GET",
-        auth_settings=["BearerToken"],
-        response_type="V1ConfigMapList",
-        _return_http_data_only=True,
-    )
-    json_wf = dumps(wf.to_dict(), default=str)
-    return {"get_argo_workflows": json_wf}
+@refresh_on_unauthorized
+def get_argo_workflows(self, label_selector=None):
+    """
+    Retrieve all running argo workflows and return the phase of each
+    by name, or None if it has no phase yet.
+    The workflows can be limited to those matching a label_selector,
+    and are requested in pages of WORKFLOW_PAGE_SIZE.
+    """
+    client_api = api_client()
+    query_params = [("limit", WORKFLOW_PAGE_SIZE)]
+    if label_selector:
+        query_params.append(("labelSelector", label_selector))
+
+    phases = {}
+    while True:
+        page = client_api.call_api(
+            "/apis/argoproj.io/v1alpha1/workflows",
+            "GET",
+            query_params=query_params,
+            header_params={"Accept": WORKFLOW_METADATA_ACCEPT},
+            auth_settings=["BearerToken"],
+            response_type="object",
+            _return_http_data_only=True,
+        )
+        for wf in page["items"]:
+            metadata = wf["metadata"]
+            labels = metadata.get("labels") or {}
+            phases[metadata["name"]] = labels.get(ARGO_PHASE_LABEL)
+
+        # continue with the next page, if any
+        token = page["metadata"].get("continue")
+        if not token:
+            break
+        query_params = [p for p in query_params if p[0] != "continue"]
+        query_params.append(("continue", token))
+
+    return {"get_argo_workflows": phases}
 
 
 @shared_task(bind=True, throws=(HTTPError))
+@refresh_on_unauthorized
 def get_kube_log(self, wf_id, tail=25):
     """
     Retrieve the log of a container and return container id and log
     """
-    client_api = config.new_client_from_config()
+    client_api = api_client()
     v1 = client.CoreV1Api(client_api)
     log = ""
     pods = v1.list_namespaced_pod(
@@ -78,26 +172,127 @@ def get_kube_log(self, wf_id, tail=25):
 
 
 @shared_task(bind=True, throws=(HTTPError))
+@refresh_on_unauthorized
+def get_kube_logs(self, wf_ids, tail=25, cursors=None):
+    """
+    Retrieve the logs of the containers of multiple workflows and return
+    them by workflow id. All workflow pods are listed in one request and
+    their logs are read concurrently.
+
+    Cursors hold the timestamp of the last log line per pod by workflow id.
+    For pods with a cursor only newer lines are returned, the others return
+    their last tail lines. The new cursors are returned as log_cursors.
+    """
+    client_api = api_client()
+    v1 = client.CoreV1Api(client_api)
+    cursors = cursors or {}
+    wanted = set(wf_ids)
+    pods = v1.list_namespaced_pod(
+        "default", label_selector="workflows.argoproj.io/workflow"
+    )
+
+    names = []
+    for item in pods.to_dict().get("items", []):
+        labels = item["metadata"].get("labels") or {}
+        wf_id = labels.get("workflows.argoproj.io/workflow")
+        if wf_id in wanted:
+            names.append((wf_id, item["metadata"]["name"]))
+
+    def read_log(wf_id_and_name):
+        wf_id, name = wf_id_and_name
+        cursor = cursors.get(wf_id, {}).get(name)
+        try:
+            return _read_pod_log_since(v1, name, tail, cursor)
+        except Exception as e:
+            logger.warning("Failed to read log of pod {}: {}".format(name, e))
+            return "", cursor
+
+    logs = {wf_id: "" for wf_id in wf_ids}
+    log_cursors = {wf_id: {} for wf_id in wf_ids}
+    with ThreadPoolExecutor(max_workers=LOG_WORKERS) as pool:
+        for (wf_id, name), (podlog, cursor) in zip(names, pool.map(read_log, names)):
+            logs[wf_id] += podlog
+            if cursor is not None:
+                log_cursors[wf_id][name] = cursor
+
+    return {"get_kube_logs": logs, "log_cursors": log_cursors}
+
+
+def _read_pod_log_since(v1, name, tail, cursor):
+    """
+    Read the log lines of a pod after the cursor timestamp, or its last tail
+    lines without a cursor. Returns the log and the timestamp of its last line.
+    """
+    if cursor is None:
+        options = {"tail_lines": tail}
+    else:
+        # the client has no sinceTime, so ask a few seconds more to
+        # allow for clock skew and drop the lines we already have
+        seconds = time() - _timestamp_seconds(cursor) + LOG_CLOCK_MARGIN
+        options = {"since_seconds": max(1, int(seconds))}
+
+    podlog = v1.read_namespaced_pod_log(
+        name, "default", container="main", timestamps=True, **options
+    )
+
+    lines = []
+    last = _timestamp_key(cursor) if cursor is not None else None
+    for line in podlog.splitlines():
+        timestamp, _, text = line.partition(" ")
+        key = _timestamp_key(timestamp)
+        if last is not None and key is not None and key <= last:
+            continue
+        lines.append(text)
+        if key is not None:
+            last, cursor = key, timestamp
+
+    log = "".join(line + "\n" for line in lines)
+    return log, cursor
+
+
+def _timestamp_key(timestamp):
+    """
+    Sortable (seconds, nanoseconds) of an RFC3339 log timestamp like
+    2021-01-01T12:00:00.123456789Z, or None if it isn't one.
+    """
+    try:
+        date, _, fraction = timestamp.rstrip("Z").partition(".")
+        seconds = calendar.timegm(
+            datetime.strptime(date, "%Y-%m-%dT%H:%M:%S").timetuple()
+        )
+        return seconds, int(fraction.ljust(9, "0")[:9] or 0)
+    except ValueError:
+        return None
+
+
+def _timestamp_seconds(timestamp):
+    key = _timestamp_key(timestamp)
+    return key[0] + key[1] / 1e9 if key is not None else 0
+
+
+@shared_task(bind=True, throws=(HTTPError))
+@refresh_on_unauthorized
 def do_argo_create(self, yaml):
     """
-    Start a deployment with a specific yaml workflow
+    Start a deployment with a specific yaml workflow and return its name.
     """
-    client_api = config.new_client_from_config()
+    client_api = api_client()
     crd = client.CustomObjectsApi(client_api)
     status = crd.create_namespaced_custom_object(
         "argoproj.io", "v1alpha1", "default", "workflows", yaml
     )
 
-    return {"do_argo_create": status}
+    return {"do_argo_create": status["metadata"]["name"]}
 
 
 @shared_task(bind=True, throws=(HTTPError,))
+@refresh_on_unauthorized
 def do_argo_stop(self, wf_id):
     """
-    Stop argo workflow by deleting running pod
+    Stop argo workflow by deleting running pod and return the pod name.
     """
-    status = {}
-    client_api = config.new_client_from_config()
+    stopped = None
+    client_api = api_client()
     v1 = client.CoreV1Api(client_api)
     pods = v1.list_namespaced_pod(
         "default", label_selector="workflows.argoproj.io/workflow={}".format(wf_id)
@@ -113,24 +308,26 @@ def do_argo_stop(self, wf_id):
         ):
             name = item["metadata"]["name"]
             try:
-                status = v1.delete_namespaced_pod(name, "default").to_dict()
+                v1.delete_namespaced_pod(name, "default")
+                stopped = name
             except ApiException as e:
                 logger.error("Exception when deleting a pod: {}\n".format(e))
             break
 
-    return {"do_argo_stop": status}
+    return {"do_argo_stop": stopped}
 
 
 @shared_task(bind=True, throws=(HTTPError))
+@refresh_on_unauthorized
 def do_argo_remove(self, workflow_id):
     """
     Remove a container with a specific id and return id.
     Try to write the docker log output as well.
     """
-    client_api = config.new_client_from_config()
+    client_api = api_client()
     crd = client.CustomObjectsApi(client_api)
-    status = crd.delete_namespaced_custom_object(
+    crd.delete_namespaced_custom_object(
         "argoproj.io", "v1alpha1", "default", "workflows", workflow_id
-        )
+    )
 
-    return {"do_argo_remove": status}
+    return {"do_argo_remove": workflow_id}
@@ -6,15 +6,20 @@ from time import time
 
 from django.test import TestCase
 from fakeredis import FakeStrictRedis
+from kubernetes.client.rest import ApiException
 from mock import MagicMock, Mock, patch
 
 from delft3dcontainermanager.tasks import (
+    WORKFLOW_METADATA_ACCEPT,
+    WORKFLOW_PAGE_SIZE,
     delft3dgt_kube_pulse,
     do_argo_create,
     do_argo_remove,
     do_argo_stop,
     get_argo_workflows,
     get_kube_log,
+    get_kube_logs,
+    reset_api_client,
 )
 
 
@@ -63,25 +68,76 @@ class TaskTest(TestCase):
         self.redis = FakeStrictRedis()
         self.mocked_redis.return_value = self.redis
 
+        # every test mocks its own kubernetes client
+        reset_api_client()
+
+    @patch("delft3dcontainermanager.tasks.client", **mock_options)
+    @patch("delft3dcontainermanager.tasks.config", **mock_options)
+    def test_api_client_cache(self, mockConfig, mockClient):
+        """
+        Assert that the kubeconfig is only read again when
+        the client is outdated or its credentials are rejected.
+        """
+        do_argo_remove.delay("id")
+        do_argo_remove.delay("id")
+        self.assertEqual(mockConfig.new_client_from_config.call_count, 1)
+
+        with patch("delft3dcontainermanager.tasks.API_CLIENT_MAX_AGE", -1):
+            do_argo_remove.delay("id")
+        self.assertEqual(mockConfig.new_client_from_config.call_count, 2)
+
+        delete = mockClient.CustomObjectsApi().delete_namespaced_custom_object
+        delete.side_effect = [ApiException(status=401), {}]
+        do_argo_remove.delay("id")
+        self.assertEqual(mockConfig.new_client_from_config.call_count, 3)
+        self.assertEqual(delete.call_count, 5)
+
     @patch("delft3dcontainermanager.tasks.client", **mock_options)
     @patch("delft3dcontainermanager.tasks.config", **mock_options)
     def test_get_argo_workflows(self, mockConfig, mockClient):
         """
         Assert that the get_argo_workflows task
-        calls the kubernetes v1.api_client.call_api function.
+        calls the kubernetes v1.api_client.call_api function
+        for every page of workflows.
         """
 
-        # Mock return of all workflows
+        def workflow(name):
+            return {
+                "metadata": {
+                    "name": name,
+                    "labels": {"workflows.argoproj.io/phase": "Running"},
+                    "managedFields": [{"manager": "workflow-controller"}],
+                },
+                "status": {"nodes": {}},
+            }
+
+        # Mock return of all workflows in two pages
         mockConfig.new_client_from_config.return_value = Mock()
-        get_argo_workflows.delay()
-        mockConfig.new_client_from_config().call_api.assert_called_with(
+        call_api = mockConfig.new_client_from_config().call_api
+        call_api.side_effect = [
+            {"metadata": {"continue": "next"}, "items": [workflow("a")]},
+            {"metadata": {}, "items": [{"metadata": {"name": "b"}}]},
+        ]
+        result = get_argo_workflows.delay(label_selector="app=delft3dgt").result
+
+        self.assertEqual(call_api.call_count, 2)
+        call_api.assert_called_with(
             "/apis/argoproj.io/v1alpha1/workflows",
             "GET",
+            query_params=[
+                ("limit", WORKFLOW_PAGE_SIZE),
+                ("labelSelector", "app=delft3dgt"),
+                ("continue", "next"),
+            ],
+            header_params={"Accept": WORKFLOW_METADATA_ACCEPT},
             auth_settings=["BearerToken"],
-            response_type="V1ConfigMapList",
+            response_type="object",
             _return_http_data_only=True,
         )
 
+        # only the phases by name are returned
+        self.assertEqual(result, {"get_argo_workflows": {"a": "Running", "b": None}})
+
     @patch("delft3dcontainermanager.tasks.client", **mock_options)
     @patch("delft3dcontainermanager.tasks.config", **mock_options)
     def test_get_kube_log(self, mockConfig, mockClient):
@@ -108,6 +164,60 @@ class TaskTest(TestCase):
             pod_id, "default", container="main", tail_lines=25
         )
 
+    @patch("delft3dcontainermanager.tasks.client", **mock_options)
+    @patch("delft3dcontainermanager.tasks.config", **mock_options)
+    def test_get_kube_logs(self, mockConfig, mockClient):
+        """
+        Assert that the get_kube_logs task lists all
+        workflow pods once and returns the logs by workflow.
+        """
+
+        def pod(name, wf_id):
+            labels = {"workflows.argoproj.io/workflow": wf_id}
+            return {"metadata": {"name": name, "labels": labels}}
+
+        # Mock return of all pods
+        pods = Mock()
+        pods.to_dict.return_value = {
+            "items": [pod("a-1", "a"), pod("a-2", "a"), pod("c-1", "c")]
+        }
+        v1 = mockClient.CoreV1Api()
+        v1.list_namespaced_pod.return_value = pods
+        v1.read_namespaced_pod_log.side_effect = lambda name, *args, **kwargs: (
+            "2021-01-01T12:00:00.5Z {0} first\n2021-01-01T12:00:01Z {0} last\n"
+        ).format(name)
+
+        result = get_kube_logs.delay(["a", "b"]).result
+        v1.list_namespaced_pod.assert_called_once_with(
+            "default", label_selector="workflows.argoproj.io/workflow"
+        )
+        v1.read_namespaced_pod_log.assert_called_with(
+            "a-2", "default", container="main", timestamps=True, tail_lines=25
+        )
+        self.assertEqual(v1.read_namespaced_pod_log.call_count, 2)
+        self.assertEqual(
+            result["get_kube_logs"],
+            {"a": "a-1 first\na-1 last\na-2 first\na-2 last\n", "b": ""},
+        )
+        self.assertEqual(
+            result["log_cursors"],
+            {
+                "a": {"a-1": "2021-01-01T12:00:01Z", "a-2": "2021-01-01T12:00:01Z"},
+                "b": {},
+            },
+        )
+
+        # with a cursor only newer lines are returned
+        cursors = {"a": {"a-1": "2021-01-01T12:00:00.75Z"}}
+        result = get_kube_logs.delay(["a"], cursors=cursors).result
+        self.assertEqual(
+            result["get_kube_logs"],
+            {"a": "a-1 last\na-2 first\na-2 last\n"},
+        )
+        calls = v1.read_namespaced_pod_log.call_args_list[2:]
+        options = [kwargs for args, kwargs in calls if args[0] == "a-1"][0]
+        self.assertIn("since_seconds", options)
+
     @patch("delft3dcontainermanager.tasks.client", **mock_options)
     @patch("delft3dcontainermanager.tasks.config", **mock_options)
     def test_do_argo_create(self, mockConfig, mockClient):
@@ -116,8 +226,11 @@ class TaskTest(TestCase):
         calls the kubernetes create_namespaced_custom_object function.
         """
         yaml = "---"
+        create = mockClient.CustomObjectsApi().create_namespaced_custom_object
+        create.return_value = {"metadata": {"name": "wf"}, "spec": {}}
 
-        do_argo_create.delay(yaml)
+        result = do_argo_create.delay(yaml).result
+        self.assertEqual(result, {"do_argo_create": "wf"})
         mockClient.CustomObjectsApi().create_namespaced_custom_object.assert_called_with(
             "argoproj.io", "v1alpha1", "default", "workflows", yaml
         )
@@ -147,7 +260,8 @@ class TaskTest(TestCase):
         }
         mockClient.CoreV1Api().list_namespaced_pod.return_value = pods
 
-        do_argo_stop.delay(wf_id)
+        result = do_argo_stop.delay(wf_id).result
+        self.assertEqual(result, {"do_argo_stop": pod_id})
         mockClient.CoreV1Api().list_namespaced_pod.assert_called_with(
             "default", label_selector="workflows.argoproj.io/workflow={}".format(wf_id)
         )
@@ -163,7 +277,8 @@ class TaskTest(TestCase):
         calls the kubernetes delete_namespaced_custom_object function
         """
         wf_id = "id"
-        do_argo_remove.delay(wf_id)
+        result = do_argo_remove.delay(wf_id).result
+        self.assertEqual(result, {"do_argo_remove": wf_id})
         mockClient.CustomObjectsApi().delete_namespaced_custom_object.assert_called_with(
             "argoproj.io", "v1alpha1", "default", "workflows", wf_id
         )
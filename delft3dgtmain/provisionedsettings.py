@@ -0,0 +1,16 @@
+SECRET_KEY = "local"
+DATABASES = {"default": {"ENGINE": "django.db.backends.postgresql_psycopg2", "NAME": "djangodb", "USER": "django", "HOST": "127.0.0.1", "PORT": "5432"}}
+WORKER_FILEDIR = "/tmp/files"
+BUCKETNAME = "s3bucket"
+REQUIRE_REVIEW = False
+# OIDC
+OIDC_RP_CLIENT_ID = ""
+OIDC_RP_CLIENT_SECRET = ""
+OIDC_RP_SIGN_ALGO = ""
+OIDC_OP_AUTHORIZATION_ENDPOINT = ""
+OIDC_OP_TOKEN_ENDPOINT = ""
+OIDC_OP_USER_ENDPOINT = ""
+OIDC_OP_JWKS_ENDPOINT = ""
+LOGIN_REDIRECT_URL = ""
+LOGOUT_REDIRECT_URL = ""
+CELERY_ONCE = {"backend": "celery_once.backends.Redis", "settings": {"url": "redis://127.0.0.1:6379/0", "default_timeout": 3600}}
@@ -170,10 +170,39 @@ CELERY_BEAT_SCHEDULE = {
         "schedule": timedelta(seconds=15),
         "options": {"queue": "beat", "expires": TASK_EXPIRE_TIME},
     },
+    "build_exports": {
+        "task": "delft3dworker.tasks.delft3dgt_build_exports",
+        "schedule": timedelta(minutes=10),
+        "options": {"expires": TASK_EXPIRE_TIME},
+    },
 }
 
+# Set when the watch_workflows command runs, it then keeps the workflow
+# cluster states up to date and the pulse no longer lists all workflows
+ARGO_WORKFLOW_WATCH = False
+
+# Labels given to every created workflow
+ARGO_WORKFLOW_LABELS = {"app.kubernetes.io/managed-by": "delft3dgt"}
+
+# Only sync the workflows matching this label selector, such as
+# "app.kubernetes.io/managed-by=delft3dgt". Workflows created before
+# ARGO_WORKFLOW_LABELS existed are not labeled, so it is off by default.
+ARGO_WORKFLOW_SELECTOR = None
+
 WORKER_FILEURL = "/files"
 
+# Number of scenes of a new scenario created at once in the background
+SCENARIO_CHUNK_SIZE = 100
+# Queue of the tasks creating these scenes, they don't expire so a worker
+# should consume this queue, apart from the beat queue of the heartbeat
+SCENARIO_TASK_QUEUE = "scenarios"
+
+# Scene and scenario lists are paginated when a cursor or page_size is given
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+# Lists are counted up to this many objects, beyond it the count is estimated
+API_EXACT_COUNT_LIMIT = 10000
+
 
 # REST Framework
 
@@ -16,6 +16,7 @@ from .models import (
     UserUsageSummary,
     Version_Docker,
     Workflow,
+    WorkflowLogChunk,
 )
 
 
@@ -76,6 +77,13 @@ class WorkflowAdmin(GuardedModelAdmin):
     pass
 
 
+@admin.register(WorkflowLogChunk)
+class WorkflowLogChunkAdmin(admin.ModelAdmin):
+    list_display = ("workflow", "kind", "date_created")
+    list_filter = ("kind",)
+    raw_id_fields = ("workflow",)
+
+
 @admin.register(Version_Docker)
 class VersionAdmin(GuardedModelAdmin):
     pass
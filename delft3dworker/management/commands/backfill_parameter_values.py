@@ -0,0 +1,26 @@
+from django.core.management import BaseCommand
+
+from delft3dworker.models import Scene
+
+"""
+Backfill command for the scene search table.
+- Loop over all scenes
+- Sync their search values with their parameters and info
+
+Scenes keep their own search values up to date on save,
+so this is only needed once for scenes created before
+the search table existed.
+"""
+
+
+class Command(BaseCommand):
+    help = "Fill the scene search table from scene parameters and info"
+
+    def handle(self, *args, **options):
+
+        count = 0
+        for scene in Scene.objects.iterator():
+            scene._update_parameter_values()
+            count += 1
+
+        self.stdout.write("Updated search values of {} scenes.".format(count))
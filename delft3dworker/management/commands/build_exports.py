@@ -0,0 +1,45 @@
+from django.core.management import BaseCommand
+from django.db.models import F
+
+from delft3dworker.models import Scene
+
+"""
+Export command that's called periodically.
+- Loop over finished scenes whose output changed since their
+  archives were last built
+- Build an export archive for each of their export options
+
+The scan_fingerprint of a scene changes whenever scanbucket
+finds new output, so scenes are only visited again when their
+exported files could have changed, and downloads of finished
+scenes are served by nginx without zipping on the web worker.
+Other combinations of options are built when they are first
+requested, by the build_export_archive task.
+It runs every 10 minutes from CELERY_BEAT_SCHEDULE.
+"""
+
+
+class Command(BaseCommand):
+    help = "build export archives of finished models"
+
+    def handle(self, *args, **options):
+
+        # STEP I : Find finished models with changed output
+        fin_scenes = (
+            Scene.objects.filter(phase=Scene.phases.fin)
+            .exclude(export_fingerprint=F("scan_fingerprint"))
+            .prefetch_related("scenario__template")
+        )
+
+        # STEP II : Build an archive per export option
+        built = 0
+        for scene in fin_scenes:
+            template = scene.first_scenario().template
+            for option in template.export_options:
+                if scene.export_archive([option]) is not None:
+                    built += 1
+
+            scene.export_fingerprint = scene.scan_fingerprint
+            scene.save(update_fields=["export_fingerprint"])
+
+        self.stdout.write("Export archives built: {}".format(built))
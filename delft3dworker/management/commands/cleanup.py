@@ -6,13 +6,19 @@ from django.conf import settings  # noqa
 from django.core.management.base import BaseCommand, CommandError
 
 from delft3dworker.models import Scene
+from delft3dworker.utils import EXPORT_CACHE_DIRNAME
 
 
 class Command(BaseCommand):
     help = "Removes leftover file directories not linked to existing models."
 
     def handle(self, *args, **options):
-        ignore = set([join(settings.WORKER_FILEDIR, "theme")])  # files styling dir
+        ignore = set(
+            [
+                join(settings.WORKER_FILEDIR, "theme"),  # files styling dir
+                join(settings.WORKER_FILEDIR, EXPORT_CACHE_DIRNAME),  # archives
+            ]
+        )
         scenedirs = [
             scene.workingdir.encode("ascii", "ignore") for scene in Scene.objects.all()
         ]
@@ -1,4 +1,9 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from time import monotonic
+
 from django.core.management import BaseCommand
+from django.db import transaction
 
 from delft3dworker.models import Scene
 
@@ -6,23 +11,135 @@ from delft3dworker.models import Scene
 File scan command that's called periodically.
 - Loop over container models that are finished
 - Call local scan functions of those scenes
+- Save the updated scenes in batches
 
 Because of cloud simulations files are not local
 anymore and arrive after a delay.
 In this way, (post)processing output is added
 to the database (thus frontend) even after a model
 is finished.
+
+Scanning is I/O bound on the bucket mount, so scenes
+are scanned concurrently by a pool of threads. Only
+the main thread touches the database.
+
+Scenes whose output locations did not change are not
+scanned, and scenes that did not change in a number of
+scans in a row are settled and skipped altogether.
 """
 
 
 class Command(BaseCommand):
     help = "scan local files for finished models and update models"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=8,
+            help="Number of scenes scanned concurrently.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Number of updated scenes saved per transaction.",
+        )
+        parser.add_argument(
+            "--settle-after",
+            type=int,
+            default=10,
+            help="Number of unchanged scans after which a scene is skipped.",
+        )
+        parser.add_argument(
+            "--include-settled",
+            action="store_true",
+            help="Also scan settled scenes.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Scan and report, but don't save the scenes.",
+        )
+
     def handle(self, *args, **options):
+        start = monotonic()
 
         # STEP I : Find finished models
         fin_scenes = Scene.objects.filter(phase=Scene.phases.fin)
+        if not options["include_settled"]:
+            fin_scenes = fin_scenes.filter(scan_unchanged__lt=options["settle_after"])
 
         # STEP II : Call local scan
-        for scene in fin_scenes:
-            scene._local_scan_files()  # update images, logfile, json
+        totals = {
+            "scenes": 0,
+            "scanned": 0,
+            "updated": 0,
+            "dirs": 0,
+            "files": 0,
+            "bytes": 0,
+        }
+        # the pool is handed a batch at a time, as it would otherwise take
+        # all scenes from the iterator at once
+        batch_size = max(1, options["batch_size"])
+        scenes = fin_scenes.iterator(chunk_size=batch_size)
+        with ThreadPoolExecutor(max_workers=max(1, options["workers"])) as pool:
+            while True:
+                batch = list(islice(scenes, batch_size))
+                if not batch:
+                    break
+
+                for scene, stats in pool.map(self._scan, batch):
+                    totals["scenes"] += 1
+                    for counter, value in stats.items():
+                        totals[counter] += value
+                    if "info" in scene.changed_fields:
+                        totals["updated"] += 1
+
+                # all scenes changed, if only their count of unchanged scans
+                self._save(batch, options["dry_run"])
+
+        # STEP III : Report
+        self.stdout.write(
+            "{}Checked {scenes} scenes, scanned {scanned} ({dirs} directories, "
+            "{files} files, {bytes} bytes), updated {updated} scenes "
+            "in {seconds:.1f}s.".format(
+                "[dry run] " if options["dry_run"] else "",
+                seconds=monotonic() - start,
+                **totals
+            )
+        )
+
+    @staticmethod
+    def _scan(scene):
+        """Scan the files of a scene without saving, runs in a worker thread."""
+        stats = {}
+        scene.changed_fields = set()
+        # update images, logfile, json if output changed
+        if scene._local_scan_changed_files(commit=False, stats=stats):
+            stats["scanned"] = 1
+        return scene, stats
+
+    @staticmethod
+    def _save(scenes, dry_run):
+        if dry_run or not scenes:
+            return
+
+        scanned = [s for s in scenes if "scan_fingerprint" in s.changed_fields]
+        unchanged = [s for s in scenes if "scan_fingerprint" not in s.changed_fields]
+
+        with transaction.atomic():
+            Scene.objects.bulk_update(
+                scanned, ["info", "scan_index", "scan_fingerprint", "scan_unchanged"]
+            )
+            # only scenes with new output get a new stamp
+            Scene.objects.bulk_update(
+                [s for s in scanned if "stamp" in s.changed_fields], ["stamp"]
+            )
+            # counting unchanged scans changes nothing clients see
+            Scene.objects.bulk_update(unchanged, ["scan_unchanged"])
+
+            # bulk_update skips save(), so refresh the search values here
+            for scene in scanned:
+                if "info" in scene.changed_fields:
+                    scene._update_parameter_values()
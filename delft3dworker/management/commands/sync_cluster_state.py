@@ -1,9 +1,12 @@
 import logging
-from json import loads
-from time import sleep
+from itertools import groupby
 
+from celery.exceptions import TimeoutError
 from celery.result import AsyncResult
+from ddtrace import tracer
+from django.conf import settings
 from django.core.management import BaseCommand
+from django.db.models import F, Q
 
 from delft3dcontainermanager.tasks import do_argo_remove, get_argo_workflows
 from delft3dworker.models import Scene, Template, Workflow
@@ -13,10 +16,13 @@ Synchronization command that's called periodically.
 - Update Django state from previously ran celery tasks
 - Retrieve all running workflows in kubernetes
 - Loop over Django workflows models and sync with cluster state
-- Loop over the scene models and update phases where needed
+- Loop over the active scene models and update phases where needed
 - Call new celery tasks for workflows based on updated scene phases
 """
 
+# Seconds to wait for the list of cluster workflows
+WORKFLOWS_TIMEOUT = 30
+
 
 class Command(BaseCommand):
     help = "Sync cluster workflows with workflow and scene models."
@@ -28,8 +34,8 @@ class Command(BaseCommand):
         self._update_workflow_tasks()
 
         # STEP II : Get current workflows on cluster and sync with
-        # Djang workflows models
-        if self._get_latest_workflows_status():
+        # Djang workflows models, unless they are watched already
+        if settings.ARGO_WORKFLOW_WATCH or self._get_latest_workflows_status():
 
             # STEP III : Update Scenes and their Phases
             # Controls workflow desired states
@@ -42,42 +48,70 @@ class Command(BaseCommand):
         """
         Update workflows with results from finished tasks.
         """
-        workflows_with_running_tasks = set(
-            Workflow.objects.exclude(task_uuid__exact=None)
-        )
-
-        for workflow in workflows_with_running_tasks:
-            workflow.update_task_result()
+        workflows_with_running_tasks = Workflow.objects.exclude(
+            task_uuid__exact=None
+        ).order_by("task_uuid")
+
+        # all workflows share the result of a get_kube_logs task, so read
+        # it once per task and hand every workflow its own part of it
+        changed_workflows = []
+        for task_uuid, workflows in groupby(
+            workflows_with_running_tasks, key=lambda workflow: workflow.task_uuid
+        ):
+            result = AsyncResult(id=str(task_uuid))
+            for workflow in workflows:
+                workflow.update_task_result(result, commit=False)
+                if getattr(workflow, "changed_fields", None):
+                    changed_workflows.append(workflow)
+
+        self._bulk_update(Workflow, changed_workflows)
 
     def _get_latest_workflows_status(self):
         """
         Synchronise local Django Workflow models with remote Argo workflows
         """
 
-        ps = get_argo_workflows.apply_async(queue="priority")
-        shortnames = tuple(Template.objects.values_list("shortname", flat=True))
-
-        # Wait until the task finished successfully
-        # or return if waiting too long
-        checked = 0
-        # TODO Use get or avoid warning
-        while not ps.successful():
-            sleep(1)
+        ps = get_argo_workflows.apply_async(
+            kwargs={"label_selector": settings.ARGO_WORKFLOW_SELECTOR},
+            queue="priority",
+        )
 
+        # Wait until the task finished, the result backend notifies us
+        # as soon as it did. This command runs in the pulse task, which
+        # only waits for this task, so waiting in a task is allowed here.
+        try:
+            ps.get(
+                timeout=WORKFLOWS_TIMEOUT,
+                propagate=False,
+                disable_sync_subtasks=False,
+            )
+        except TimeoutError:
             # if things take too long, revoke the task and return
-            checked += 1
-            if checked >= 30:
-                ps.revoke()
-                return False
+            ps.revoke()
+            return False
+        if not ps.successful():
+            return False
 
-        # task is succesful, so we're getting the result and create a set
-        cluster_workflows_json = ps.result["get_argo_workflows"]
-        cluster_workflows = loads(cluster_workflows_json)
-        cluster_dict = {wf["metadata"]["name"]: wf for wf in cluster_workflows["items"]}
-        cluster_set = set(cluster_dict.keys())
+        # task is succesful, so we're getting the phases by workflow name
+        self._sync_cluster_workflows(ps.result["get_argo_workflows"])
+
+        return True  # successful
+
+    def _sync_cluster_workflows(self, cluster_phases, names=None):
+        """
+        Update the cluster_state of the Django Workflow models from the
+        given Argo workflow phases by name, and remove Argo workflows which
+        are not in the database. Only the given names are compared if set,
+        otherwise all workflows. Returns the workflows that changed state.
+        """
+        shortnames = tuple(Template.objects.values_list("shortname", flat=True))
+        cluster_set = set(cluster_phases.keys())
 
         # retrieve workflows from database
-        database_set = set(Workflow.objects.all().values_list("name", flat=True))
+        database_workflows = Workflow.objects.all()
+        if names is not None:
+            database_workflows = database_workflows.filter(name__in=names)
+        database_set = set(database_workflows.values_list("name", flat=True))
 
         # Work out matching matrix
         #       argo wf yes no
@@ -94,12 +128,19 @@ class Command(BaseCommand):
             - (cluster_set & database_set)
         )
 
-        # Update state of all matching workflows
+        # Update state of all matching workflows in a single query
+        # and only write the workflows whose state changed
         workflow_match = m_1_1 | m_1_0
-        for wf_name in workflow_match:
-            snapshot = cluster_dict[wf_name] if wf_name in cluster_dict else None
-            for wf in Workflow.objects.filter(name=wf_name):
-                wf.sync_cluster_state(snapshot)
+        changed_workflows = []
+        for wf in Workflow.objects.filter(name__in=workflow_match).only(
+            "id", "name", "cluster_state"
+        ):
+            # a new workflow has no phase yet
+            if wf.name in cluster_phases and cluster_phases[wf.name] is None:
+                continue
+            if wf.update_cluster_phase(cluster_phases.get(wf.name)):
+                changed_workflows.append(wf)
+        Workflow.objects.bulk_update(changed_workflows, ["cluster_state"])
 
         # Call error for mismatch and remove workflow
         # but only if its name matches existing Templates,
@@ -113,7 +154,7 @@ class Command(BaseCommand):
                 self.stderr.write(msg)
                 do_argo_remove.delay(wf)
 
-        return True  # successful
+        return changed_workflows
 
     def _update_scene_phases(self):
         """
@@ -121,13 +162,67 @@ class Command(BaseCommand):
         shift Scene phase
         """
 
+        # only scenes in an active phase can shift without user action
+        scenes = (
+            Scene.objects.filter(phase__in=Scene.ACTIVE_PHASES)
+            .select_related("workflow")
+            .prefetch_related("scenario__template__versions")
+            .order_by("date_started", "id")
+        )
+
         # ordering is done on start date (first, and id second):
         # if a simulation slot is available, we want simulations to start
         # in order of their date_started
-        for scene in Scene.objects.all().order_by("date_started", "id"):
-            scene.update_and_phase_shift()
+        changed_scenes, changed_workflows = [], []
+        scenes = list(scenes)
+        self._report_active_set(len(scenes))
+        for scene in scenes:
+            scene.update_and_phase_shift(commit=False)
+            if getattr(scene, "changed_fields", None):
+                changed_scenes.append(scene)
+            workflow = getattr(scene, "workflow", None)
+            if getattr(workflow, "changed_fields", None):
+                changed_workflows.append(workflow)
+
+        # write all changes per field, so unchanged fields are left alone
+        self._bulk_update(Scene, changed_scenes)
+        self._bulk_update(Workflow, changed_workflows)
+
+        # bulk_update skips save(), so refresh the search values here
+        for scene in changed_scenes:
+            if "info" in scene.changed_fields:
+                scene._update_parameter_values()
+
+    def _bulk_update(self, model, instances):
+        """Write the collected changed_fields of instances per field."""
+        fields = set().union(*[instance.changed_fields for instance in instances])
+        for field in sorted(fields):
+            model.objects.bulk_update(
+                [
+                    instance
+                    for instance in instances
+                    if field in instance.changed_fields
+                ],
+                [field],
+            )
 
     def _fix_workflow_state_mismatch(self):
         """Call celery tasks for each Workflow where applicable."""
-        for workflow in Workflow.objects.all():
-            workflow.fix_mismatch_or_log()
+        # skip settled workflows of inactive scenes, there is nothing to fix
+        workflows = Workflow.objects.filter(
+            Q(scene__phase__in=Scene.ACTIVE_PHASES)
+            | Q(cluster_state="running")
+            | ~Q(desired_state=F("cluster_state"))
+        ).select_related("scene")
+        for workflow in workflows:
+            workflow.fix_mismatch()
+
+        # Request the logs of all running workflows in a single task
+        Workflow.update_logs(workflows)
+
+    def _report_active_set(self, size):
+        """Log the number of active scenes and tag the current trace with it."""
+        logging.info("Heartbeat active set: {} scenes".format(size))
+        span = tracer.current_root_span()
+        if span is not None:
+            span.set_metric("delft3dgt.heartbeat.active_scenes", size)
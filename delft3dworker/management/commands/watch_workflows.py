@@ -0,0 +1,162 @@
+import logging
+from time import sleep
+
+from django.conf import settings
+from kubernetes import client, watch
+from kubernetes.client.rest import ApiException
+
+from delft3dcontainermanager.tasks import (
+    ARGO_PHASE_LABEL,
+    api_client,
+    delft3dgt_kube_pulse,
+    reset_api_client,
+)
+from delft3dworker.management.commands.sync_cluster_state import (
+    Command as SyncCommand,
+)
+
+"""
+Long running command that keeps the workflow cluster states up to date.
+- List all Argo workflows once and sync them with the workflow models
+- Watch the Argo workflows from that resourceVersion on and sync every
+  workflow as soon as it changes
+- Start a sync_cluster_state run for every change, so scene phases follow
+- List again when the resourceVersion has expired
+Run it with ARGO_WORKFLOW_WATCH enabled, so the periodic sync no longer
+lists all workflows itself.
+"""
+
+ARGO_GROUP = "argoproj.io"
+ARGO_VERSION = "v1alpha1"
+ARGO_PLURAL = "workflows"
+
+# Seconds after which the cluster closes a watch request, it is resumed
+WATCH_TIMEOUT = 5 * 60
+
+# Seconds to wait before watching again after a failed watch request
+WATCH_BACKOFF = 5
+
+HTTP_UNAUTHORIZED = 401
+HTTP_GONE = 410
+
+
+class Command(SyncCommand):
+    help = "Watch cluster workflows and sync them with workflow models."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--timeout",
+            type=int,
+            default=WATCH_TIMEOUT,
+            help="Seconds after which a watch request is resumed.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Stop after a single watch request.",
+        )
+
+    def handle(self, *args, **options):
+        if not settings.ARGO_WORKFLOW_WATCH:
+            self.stderr.write(
+                "ARGO_WORKFLOW_WATCH is not set, the periodic sync will "
+                "still list all workflows."
+            )
+
+        resource_version = None
+        while True:
+            try:
+                if resource_version is None:
+                    resource_version = self._list_workflows()
+                resource_version = self._watch_workflows(
+                    resource_version, options["timeout"]
+                )
+            except ApiException as e:
+                if e.status == HTTP_GONE:
+                    logging.info("Workflow watch expired, listing workflows.")
+                    resource_version = None
+                elif e.status == HTTP_UNAUTHORIZED:
+                    reset_api_client()
+                else:
+                    logging.error("Workflow watch failed: {}".format(e))
+                    sleep(WATCH_BACKOFF)
+
+            if options["once"]:
+                break
+
+    def _list_workflows(self):
+        """
+        Sync all workflows with the cluster and return the resourceVersion
+        to watch from.
+        """
+        workflows = client.CustomObjectsApi(api_client()).list_cluster_custom_object(
+            ARGO_GROUP,
+            ARGO_VERSION,
+            ARGO_PLURAL,
+            label_selector=settings.ARGO_WORKFLOW_SELECTOR,
+        )
+        cluster_phases = {
+            wf["metadata"]["name"]: self._phase(wf) for wf in workflows["items"]
+        }
+        if self._sync_cluster_workflows(cluster_phases):
+            self._request_sync()
+        return workflows["metadata"]["resourceVersion"]
+
+    def _watch_workflows(self, resource_version, timeout):
+        """
+        Sync every changed workflow until the watch request ends and return
+        the resourceVersion to resume from, or None when it has expired.
+        """
+        stream = watch.Watch().stream(
+            client.CustomObjectsApi(api_client()).list_cluster_custom_object,
+            ARGO_GROUP,
+            ARGO_VERSION,
+            ARGO_PLURAL,
+            label_selector=settings.ARGO_WORKFLOW_SELECTOR,
+            resource_version=resource_version,
+            timeout_seconds=timeout,
+            allow_watch_bookmarks=True,
+        )
+        for event in stream:
+            workflow = event["raw_object"]
+
+            # errors carry a Status instead of a workflow
+            if event["type"] == "ERROR":
+                if workflow.get("code") == HTTP_GONE:
+                    logging.info("Workflow watch expired, listing workflows.")
+                    return None
+                logging.error(
+                    "Workflow watch failed: {}".format(workflow.get("message"))
+                )
+                sleep(WATCH_BACKOFF)
+                return resource_version
+
+            resource_version = workflow["metadata"]["resourceVersion"]
+            if event["type"] == "BOOKMARK":
+                continue
+
+            name = workflow["metadata"]["name"]
+            if event["type"] == "DELETED":
+                cluster_phases = {}
+            else:
+                cluster_phases = {name: self._phase(workflow)}
+
+            if self._sync_cluster_workflows(cluster_phases, names=[name]):
+                self._request_sync()
+
+        return resource_version
+
+    def _phase(self, workflow):
+        """Return the phase of an Argo workflow, or None if it has none yet."""
+        labels = workflow["metadata"].get("labels") or {}
+        return labels.get(ARGO_PHASE_LABEL)
+
+    def _request_sync(self):
+        """
+        Start a sync_cluster_state run to follow up on changed workflows.
+        The pulse runs once at a time, so a request during a run is dropped
+        and picked up by the next scheduled run.
+        """
+        delft3dgt_kube_pulse.apply_async(
+            queue="beat", expires=settings.TASK_EXPIRE_TIME
+        )
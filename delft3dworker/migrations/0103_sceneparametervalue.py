@@ -0,0 +1,61 @@
+# Generated by Django 3.2.25 on 2026-10-17 13:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("delft3dworker", "0102_add_extended_view_permissions"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SceneParameterValue",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("key", models.CharField(max_length=256)),
+                ("numeric_value", models.FloatField(blank=True, null=True)),
+                ("text_value", models.CharField(blank=True, max_length=256, null=True)),
+                (
+                    "source",
+                    models.CharField(
+                        choices=[
+                            ("input", "Input parameter"),
+                            ("postprocess", "Postprocessing output"),
+                        ],
+                        max_length=16,
+                    ),
+                ),
+                (
+                    "scene",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="parameter_values",
+                        to="delft3dworker.scene",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="sceneparametervalue",
+            index=models.Index(
+                fields=["key", "numeric_value"], name="delft3dwork_key_8fb39c_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="sceneparametervalue",
+            index=models.Index(
+                fields=["key", "text_value"], name="delft3dwork_key_3e39a2_idx"
+            ),
+        ),
+    ]
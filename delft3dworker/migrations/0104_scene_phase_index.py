@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-17 13:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("delft3dworker", "0103_sceneparametervalue"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="scene",
+            name="phase",
+            field=models.PositiveSmallIntegerField(
+                choices=[
+                    (0, "New"),
+                    (6, "Idle: waiting for user input"),
+                    (11, "Starting workflow"),
+                    (12, "Running workflow"),
+                    (13, "Removing workflow"),
+                    (20, "Stopping workflow"),
+                    (21, "Removing stopped workflow"),
+                    (500, "Finished"),
+                    (501, "Failed"),
+                    (502, "Stopped"),
+                ],
+                db_index=True,
+                default=0,
+            ),
+        ),
+    ]
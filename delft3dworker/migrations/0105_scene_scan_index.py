@@ -0,0 +1,19 @@
+# Generated by Django 3.2.25 on 2026-10-17 14:02
+
+import delft3dworker.models
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("delft3dworker", "0104_scene_phase_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scene",
+            name="scan_index",
+            field=delft3dworker.models.JSONFieldTransition(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-17 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("delft3dworker", "0105_scene_scan_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scene",
+            name="scan_fingerprint",
+            field=models.CharField(blank=True, max_length=40),
+        ),
+        migrations.AddField(
+            model_name="scene",
+            name="scan_unchanged",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
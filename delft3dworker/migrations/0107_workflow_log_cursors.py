@@ -0,0 +1,19 @@
+# Generated by Django 3.2.25 on 2026-10-17 14:09
+
+import delft3dworker.models
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("delft3dworker", "0106_scene_scan_fingerprint"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="workflow",
+            name="log_cursors",
+            field=delft3dworker.models.JSONFieldTransition(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,91 @@
+# Generated by Django 3.2.25 on 2026-10-17 14:10
+
+import delft3dworker.utils
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Workflows whose log chunks are written at once
+BATCH_SIZE = 500
+
+
+def forwards_func(apps, schema_editor):
+    # keep the existing logs as their first chunk
+    Workflow = apps.get_model("delft3dworker", "Workflow")
+    WorkflowLogChunk = apps.get_model("delft3dworker", "WorkflowLogChunk")
+
+    db_alias = schema_editor.connection.alias
+    workflows = (
+        Workflow.objects.using(db_alias)
+        .only("id", "cluster_log", "action_log")
+        .iterator(chunk_size=BATCH_SIZE)
+    )
+
+    # write the chunks per batch of workflows, so the logs of all
+    # workflows are never held in memory at once
+    chunks = []
+    for count, workflow in enumerate(workflows, 1):
+        for kind, text in [
+            ("cluster", workflow.cluster_log),
+            ("action", workflow.action_log),
+        ]:
+            if text:
+                chunks.append(
+                    WorkflowLogChunk(workflow_id=workflow.pk, kind=kind, text=text)
+                )
+        if count % BATCH_SIZE == 0:
+            WorkflowLogChunk.objects.using(db_alias).bulk_create(chunks)
+            chunks = []
+    WorkflowLogChunk.objects.using(db_alias).bulk_create(chunks)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("delft3dworker", "0107_workflow_log_cursors"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="WorkflowLogChunk",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[("cluster", "Cluster log"), ("action", "Action log")],
+                        default="cluster",
+                        max_length=16,
+                    ),
+                ),
+                (
+                    "date_created",
+                    models.DateTimeField(default=delft3dworker.utils.tz_now),
+                ),
+                ("text", models.TextField()),
+                (
+                    "workflow",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="log_chunks",
+                        to="delft3dworker.workflow",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="workflowlogchunk",
+            index=models.Index(
+                fields=["workflow", "kind", "id"], name="delft3dwork_workflo_7b78bd_idx"
+            ),
+        ),
+        migrations.RunPython(forwards_func, migrations.RunPython.noop),
+    ]
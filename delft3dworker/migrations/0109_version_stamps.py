@@ -0,0 +1,34 @@
+# Generated by Django 3.2.25 on 2026-10-17 14:32
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("delft3dworker", "0108_workflowlogchunk"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scenario",
+            name="stamp",
+            field=models.UUIDField(default=uuid.uuid4, editable=False),
+        ),
+        migrations.AddField(
+            model_name="scene",
+            name="stamp",
+            field=models.UUIDField(default=uuid.uuid4, editable=False),
+        ),
+        migrations.AddField(
+            model_name="searchform",
+            name="stamp",
+            field=models.UUIDField(default=uuid.uuid4, editable=False),
+        ),
+        migrations.AddField(
+            model_name="template",
+            name="stamp",
+            field=models.UUIDField(default=uuid.uuid4, editable=False),
+        ),
+    ]
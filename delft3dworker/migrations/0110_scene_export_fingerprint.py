@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-17 15:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("delft3dworker", "0109_version_stamps"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scene",
+            name="export_fingerprint",
+            field=models.CharField(blank=True, max_length=40),
+        ),
+    ]
@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 
 import copy
+import glob
 import hashlib
 import json
 import logging
@@ -13,9 +14,10 @@ import yaml
 
 from celery.result import AsyncResult
 from django.conf import settings  # noqa
-from django.contrib.auth.models import Group, User
+from django.contrib.auth.models import Group, Permission, User
+from django.contrib.contenttypes.models import ContentType
 from django.core.files.base import ContentFile
-from django.db import models
+from django.db import models, transaction
 from django.db.models import JSONField
 from django.utils.text import slugify
 from django.utils.timezone import now
@@ -25,25 +27,43 @@ from guardian.shortcuts import (
     get_objects_for_user,
     remove_perm,
 )
+from guardian.models import UserObjectPermission
 from model_utils import Choices
 from delft3dcontainermanager.tasks import (
+    ARGO_PHASE_LABEL,
     do_argo_create,
     do_argo_remove,
     do_argo_stop,
     get_argo_workflows,
     get_kube_log,
+    get_kube_logs,
 )
 from delft3dworker.utils import (
+    EXPORT_CACHE_DIRNAME,
     derive_defaults_from_argo,
+    export_archive_name,
     log_progress_parser,
     merge_list_of_dict,
     merge_log_unique,
+    output_fingerprint,
     scan_output_files,
+    scene_parameter_values,
     tz_now,
+    write_zip,
 )
 
 # ################################### VERSION_DOCKER, SCENARIO, SCENE
 
+# Object permissions of the owner of a new scene
+OWNER_SCENE_PERMISSIONS = [
+    "add_scene",
+    "change_scene",
+    "delete_scene",
+    "view_scene",
+    "extended_view_scene",
+]
+
+
 # For backwards compatibility in migrations
 def default_svn_version():
     pass
@@ -58,6 +78,39 @@ class JSONFieldTransition(JSONField):
         return value
 
 
+class VersionStamped(models.Model):
+    """
+    Abstract model with a stamp that changes on every save, so the API
+    can tell a client its copy is still current. A random stamp, unlike a
+    counter, can't be written twice by concurrent saves.
+    """
+
+    stamp = models.UUIDField(default=uuid.uuid4, editable=False)
+
+    # Fields clients see, saving only other fields keeps the stamp.
+    # None if clients see all fields.
+    stamped_fields = None
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None:
+            self.stamp = uuid.uuid4()
+        elif self.changes_stamp(update_fields):
+            self.stamp = uuid.uuid4()
+            kwargs["update_fields"] = set(update_fields) | {"stamp"}
+        super(VersionStamped, self).save(*args, **kwargs)
+
+    @classmethod
+    def changes_stamp(cls, fields):
+        """Return whether changing the given fields issues a new stamp."""
+        if cls.stamped_fields is None:
+            return bool(fields)
+        return bool(cls.stamped_fields & set(fields))
+
+
 class Version_Docker(models.Model):
     """
     Stores several Docker tags used in an Argo Workflow together.
@@ -111,7 +164,7 @@ def parse_argo_workflow(instance, filename):
     return join("workflow_templates", filename)
 
 
-class Scenario(models.Model):
+class Scenario(VersionStamped):
 
     """
     Scenario model
@@ -131,6 +184,11 @@ class Scenario(models.Model):
     state = models.CharField(max_length=64, default="CREATED")
     progress = models.IntegerField(default=0)  # 0-100
 
+    # state while the scenes are created in the background
+    MATERIALIZING = "MATERIALIZING"
+    # state when not all scenes could be created
+    FAILED = "FAILED"
+
     # PROPERTY METHODS
 
     def load_settings(self, settings):
@@ -143,43 +201,109 @@ class Scenario(models.Model):
         self.save()
 
     def createscenes(self, user):
-        for i, sceneparameters in enumerate(self.scenes_parameters):
-            # Create hash
+        self._createscenes(user)
+        self.save()
+
+    def materialize(self, user, chunk_size=None):
+        """
+        Create the scenes of a MATERIALIZING scenario in chunks, keeping
+        the percentage of scene parameters handled as progress.
+        """
+        chunk_size = chunk_size or settings.SCENARIO_CHUNK_SIZE
+        total = len(self.scenes_parameters)
+        for start in range(0, total, chunk_size):
+            self._createscenes(user, start, start + chunk_size)
+            self.progress = min(start + chunk_size, total) * 100 // total
+            self.save(update_fields=["progress"])
+
+        self.state = "CREATED"
+        self.progress = 0
+        self.save(update_fields=["state", "progress"])
+
+    def _createscenes(self, user, start=0, stop=None):
+        scenes_parameters = self.scenes_parameters[start:stop]
+
+        # Create hashes
+        hashes = []
+        for sceneparameters in scenes_parameters:
             m = hashlib.sha256()
             m.update(str(sceneparameters).encode("utf-8"))
-            phash = m.hexdigest()
-
-            # Check if hash already exists
-            scenes = Scene.objects.filter(parameters_hash=phash)
-            clones = get_objects_for_user(
-                user, "view_scene", scenes, accept_global_perms=False
+            hashes.append(m.hexdigest())
+
+        # Look up the existing scenes of all hashes at once
+        scenes = Scene.objects.filter(parameters_hash__in=set(hashes))
+        clones = {}
+        for scene in get_objects_for_user(
+            user, "view_scene", scenes, accept_global_perms=False
+        ):
+            clones.setdefault(scene.parameters_hash, scene)
+
+        # Scene input is unique, or repeated within this scenario
+        new_scenes = []
+        for i, (sceneparameters, phash) in enumerate(
+            zip(scenes_parameters, hashes), start
+        ):
+            if phash in clones:
+                continue
+            scene = Scene(
+                name="{}: Run {}".format(self.name, i + 1),
+                owner=self.owner,
+                parameters=sceneparameters,
+                shared="p",  # private
+                parameters_hash=phash,
+                info=self.template.info,
+            )
+            scene._set_locations()
+            new_scenes.append(scene)
+            clones[phash] = scene
+
+        with transaction.atomic():
+            Scene.objects.bulk_create(new_scenes)
+
+            # add scenario to all scenes, whether new or clones
+            through = Scene.scenario.through
+            through.objects.bulk_create(
+                [
+                    through(scene_id=scene.pk, scenario_id=self.pk)
+                    for scene in clones.values()
+                ],
+                ignore_conflicts=True,
             )
 
-            # If so, add scenario to scene
-            if len(clones) > 0:
-                scene = clones[0]  # cannot have more than one scene
-                scene.scenario.add(self)
+            # bulk_create skips save(), so add the search values here
+            SceneParameterValue.objects.bulk_create(
+                [
+                    SceneParameterValue(
+                        scene=scene,
+                        key=key,
+                        source=source,
+                        numeric_value=numeric_value,
+                        text_value=text_value,
+                    )
+                    for scene in new_scenes
+                    for (key, source, numeric_value, text_value) in (
+                        scene_parameter_values(scene.parameters, scene.info)
+                    )
+                ]
+            )
 
-            # Scene input is unique
-            else:
-                scene = Scene(
-                    name="{}: Run {}".format(self.name, i + 1),
-                    owner=self.owner,
-                    parameters=sceneparameters,
-                    shared="p",  # private
-                    parameters_hash=phash,
-                    info=self.template.info,
+            # new scenes have no permissions yet, so assign them all at once
+            if new_scenes:
+                UserObjectPermission.objects.bulk_create(
+                    [
+                        UserObjectPermission(
+                            user=self.owner,
+                            permission=permission,
+                            content_type=permission.content_type,
+                            object_pk=str(scene.pk),
+                        )
+                        for permission in Permission.objects.filter(
+                            content_type=ContentType.objects.get_for_model(Scene),
+                            codename__in=OWNER_SCENE_PERMISSIONS,
+                        ).select_related("content_type")
+                        for scene in new_scenes
+                    ]
                 )
-                scene.save()
-                scene.scenario.add(self)
-
-                assign_perm("add_scene", self.owner, scene)
-                assign_perm("change_scene", self.owner, scene)
-                assign_perm("delete_scene", self.owner, scene)
-                assign_perm("view_scene", self.owner, scene)
-                assign_perm("extended_view_scene", self.owner, scene)
-
-        self.save()
 
     # CONTROL METHODS
 
@@ -222,24 +346,53 @@ class Scenario(models.Model):
 
     # INTERNALS
 
-    # TODO Workflow update this
-    def _update_state_and_save(self):
+    @classmethod
+    def with_scene_summary(cls, queryset):
+        """
+        Annotate the number of scenes, the number of active scenes and the
+        average scene progress, so the state of many scenarios is known
+        from a single query.
+        """
+        return queryset.annotate(
+            scene_count=models.Count("scene"),
+            scenes_active=models.Count(
+                "scene", filter=~models.Q(scene__phase=Scene.phases.idle)
+            ),
+            scene_progress=models.Avg("scene__progress"),
+        )
 
-        count = self.scene_set.all().count()
-        self.state = "inactive"
+    def _scene_summary(self):
+        if not hasattr(self, "scene_count"):
+            summary = Scenario.with_scene_summary(
+                Scenario.objects.filter(pk=self.pk)
+            ).values("scene_count", "scenes_active", "scene_progress")[0]
+            for key, value in summary.items():
+                setattr(self, key, value)
+        return self.scene_count, self.scenes_active, self.scene_progress
 
-        if count > 0:
-            progress = 0
-            for scene in self.scene_set.all():
-                progress = progress + scene.progress
-                # TODO Fix phases here
-                if scene.phase != 6:
-                    self.state = "active"
+    def current_state(self):
+        """
+        Return the state of the scenario from its scenes, without saving:
+        active while any scene is not idle.
+        """
+        # scenes are still being created, progress is set by materialize
+        if self.state in (self.MATERIALIZING, self.FAILED):
+            return self.state
 
-            self.progress = progress / count
-            self.save(update_fields=["state", "progress"])
+        count, active, _ = self._scene_summary()
+        if count > 0 and active > 0:
+            return "active"
+        return "inactive"
 
-        return self.state
+    def current_progress(self):
+        """Return the average progress of the scenes, without saving."""
+        if self.state in (self.MATERIALIZING, self.FAILED):
+            return self.progress
+
+        count, _, progress = self._scene_summary()
+        if count > 0:
+            return int(progress)
+        return self.progress
 
     def _parse_setting(self, key, setting):
         if not ("values" in setting):
@@ -285,12 +438,32 @@ class Scenario(models.Model):
         return self.name
 
 
-class Scene(models.Model):
+class Scene(VersionStamped):
 
     """
     Scene model
     """
 
+    # Fields the scene serializers show, scan bookkeeping is left out
+    stamped_fields = frozenset(
+        [
+            "date_created",
+            "date_started",
+            "fileurl",
+            "info",
+            "name",
+            "owner",
+            "parameters",
+            "phase",
+            "progress",
+            "scenario",
+            "shared",
+            "suid",
+            "task_id",
+            "workingdir",
+        ]
+    )
+
     name = models.CharField(max_length=256)
 
     suid = models.UUIDField(default=uuid.uuid4, editable=False)
@@ -303,6 +476,10 @@ class Scene(models.Model):
     fileurl = models.CharField(max_length=256)
     info = JSONFieldTransition(blank=True, default=dict)
     parameters = JSONFieldTransition(blank=True, default=dict)  # {"dt":20}
+    scan_index = JSONFieldTransition(blank=True, default=dict)  # see _local_scan_files
+    scan_fingerprint = models.CharField(max_length=40, blank=True)
+    scan_unchanged = models.PositiveSmallIntegerField(default=0)  # scans in a row
+    export_fingerprint = models.CharField(max_length=40, blank=True)  # last built
     state = models.CharField(max_length=256, default="CREATED")
     progress = models.IntegerField(default=0)
     task_id = models.CharField(max_length=256, blank=True)
@@ -335,7 +512,19 @@ class Scene(models.Model):
 
     REMOVE_WORKFLOW = [phases.sim_fin, phases.stop_fin]
 
-    phase = models.PositiveSmallIntegerField(default=phases.new, choices=phases)
+    # Phases the heartbeat acts on, all other phases wait for user input
+    ACTIVE_PHASES = [
+        phases.new,
+        phases.sim_start,
+        phases.sim_run,
+        phases.sim_fin,
+        phases.stopping,
+        phases.stop_fin,
+    ]
+
+    phase = models.PositiveSmallIntegerField(
+        default=phases.new, choices=phases, db_index=True
+    )
 
     class Meta:
         permissions = [
@@ -350,7 +539,10 @@ class Scene(models.Model):
             self.date_started = tz_now()
             self.progress = 0
             self.info = self.scenario.first().template.info
-            self.save(update_fields=["date_started", "progress", "info"])
+            self.scan_unchanged = 0
+            self.save(
+                update_fields=["date_started", "progress", "info", "scan_unchanged"]
+            )
 
     def start(self):
         # only allow a start when Scene is 'Idle'
@@ -376,6 +568,7 @@ class Scene(models.Model):
             self.shift_to_phase(self.phases.sim_start)
             self.progress = 0
             self.info = self.scenario.first().template.info
+            self.scan_unchanged = 0
             self.save()
             return True
 
@@ -403,11 +596,23 @@ class Scene(models.Model):
         Modifies zipfile and returns whether files are added.
         """
 
-        available_options = self.scenario.first().template.export_options
-        export_options = [v for (k, v) in available_options.items() if k in options]
-
         files_added = False
 
+        for abs_path, rel_path in self.export_files(options):
+            files_added = True
+            zipfile.write(abs_path, rel_path)
+
+        return files_added
+
+    def export_files(self, options):
+        """Yield the (absolute path, path in zipfile) of each file to export.
+
+        See `export` for the options.
+        """
+
+        available_options = self.first_scenario().template.export_options
+        export_options = [v for (k, v) in available_options.items() if k in options]
+
         for root, dirs, files in os.walk(self.workingdir):
             for f in files:
                 name, ext = os.path.splitext(f)
@@ -417,15 +622,55 @@ class Scene(models.Model):
                         "extensions", []
                     ):
 
-                        files_added = True
                         abs_path = os.path.join(root, f)
                         rel_path = os.path.join(
                             slugify(self.name),
                             os.path.relpath(abs_path, self.workingdir),
                         )
-                        zipfile.write(abs_path, rel_path)
+                        yield abs_path, rel_path
+                        break  # add each file only once
 
-        return files_added
+    def export_archive_path(self, options):
+        """Return the path of the zip of the exported files in the export
+        cache, relative to WORKER_FILEDIR, whether it is built yet or not.
+        None if there are no files to export.
+        """
+
+        return self._export_archive_files(options)[1]
+
+    def export_archive(self, options):
+        """Return the path of a zip of the exported files, relative to
+        WORKER_FILEDIR, or None if there are no files to export.
+
+        The archive is built once and kept in the export cache, until the
+        exported files change. Only use this for finished scenes.
+        """
+
+        files, archive = self._export_archive_files(options)
+        if archive is None:
+            return None
+
+        path = os.path.join(settings.WORKER_FILEDIR, archive)
+        if not os.path.exists(path):
+            cachedir = os.path.dirname(path)
+            os.makedirs(cachedir, exist_ok=True)
+
+            # remove outdated archives of these options
+            prefix = os.path.basename(path).rsplit("-", 1)[0]
+            for outdated in glob.glob(os.path.join(cachedir, prefix + "-*.zip")):
+                os.remove(outdated)
+
+            write_zip(files, path)
+
+        return archive
+
+    def _export_archive_files(self, options):
+        files = list(self.export_files(options))
+        if not files:
+            return files, None
+
+        name = export_archive_name(self.suid, options, files)
+        return files, os.path.join(EXPORT_CACHE_DIRNAME, name)
 
     # CRUD METHODS
 
@@ -433,11 +678,19 @@ class Scene(models.Model):
 
         # On first save
         if self.pk is None:
-            self.workingdir = os.path.join(settings.WORKER_FILEDIR, str(self.suid), "")
-            self.fileurl = os.path.join(settings.WORKER_FILEURL, str(self.suid), "")
+            self._set_locations()
 
         super(Scene, self).save(*args, **kwargs)
 
+        # Keep search table in sync when parameters or info could be changed
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None or {"parameters", "info"} & set(update_fields):
+            self._update_parameter_values()
+
+    def _set_locations(self):
+        self.workingdir = os.path.join(settings.WORKER_FILEDIR, str(self.suid), "")
+        self.fileurl = os.path.join(settings.WORKER_FILEURL, str(self.suid), "")
+
     def delete(self, deletefiles=True, *args, **kwargs):
         self.abort()
         if deletefiles:
@@ -498,82 +751,92 @@ class Scene(models.Model):
 
     # HEARTBEAT UPDATE AND SAVE
 
-    def update_and_phase_shift(self):
+    def update_and_phase_shift(self, commit=True):
+        """
+        Update the Scene with the latest state of its Workflow and shift
+        phase where needed. If commit is False, changed fields are not saved
+        but collected in `changed_fields` of this Scene and its Workflow, so
+        the heartbeat can write many of them at once.
+        """
 
         # Create Workflow model and shift to idle
         if self.phase == self.phases.new:
 
             if not hasattr(self, "workflow"):
+                template = self.first_scenario().template
                 workflow = Workflow.objects.create(
                     scene=self,
-                    name="{}-{}".format(
-                        self.scenario.first().template.shortname, self.suid
-                    ),
-                    version=self.scenario.first().template.versions.first(),  # get latest version
+                    name="{}-{}".format(template.shortname, self.suid),
+                    version=template.versions.first(),  # get latest version
                 )
                 workflow.save()
 
-            self.shift_to_phase(self.phases.idle)
+            self.shift_to_phase(self.phases.idle, commit)
 
             return
 
         # User started a scene. Create Workflow and shift if it's running.
         elif self.phase == self.phases.sim_start:
 
-            self.workflow.set_desired_state("running")
+            self.workflow.set_desired_state("running", commit)
             if self.workflow.cluster_state == "running":
-                self.shift_to_phase(self.phases.sim_run)
+                self.shift_to_phase(self.phases.sim_run, commit)
 
             elif self.workflow.cluster_state in Workflow.FINISHED:
-                self.shift_to_phase(self.phases.sim_fin)
+                self.shift_to_phase(self.phases.sim_fin, commit)
 
             return
 
         # While running, scan for new pictures
         elif self.phase == self.phases.sim_run:
-            self._local_scan_files()  # update images and logfile
-            self.progress = self.workflow.progress
-            self.save(update_fields=["progress"])
+            self._local_scan_files(commit)  # update images and logfile
+            self._set_progress(self.workflow.progress, commit)
 
             # If workflow is finished, shift to finished
             if self.workflow.cluster_state in Workflow.FINISHED:
-                self.shift_to_phase(self.phases.sim_fin)
+                self.shift_to_phase(self.phases.sim_fin, commit)
 
             # If workflow disappeared, shift back
             elif self.workflow.cluster_state == "non-existent":
                 logging.error("Lost workflow in cluster!")
-                self.shift_to_phase(self.phases.sim_start)
+                self.shift_to_phase(self.phases.sim_start, commit)
 
             return
 
         # Stop workflow, will delete pods and workflow cluster_state will show failed
         elif self.phase == self.phases.stopping:
-            self.workflow.set_desired_state("failed")
+            self.workflow.set_desired_state("failed", commit)
             if self.workflow.cluster_state == "failed":
-                self.shift_to_phase(self.phases.stop_fin)
+                self.shift_to_phase(self.phases.stop_fin, commit)
 
             return
 
         # Delete workflow in cluster
         elif self.phase in self.REMOVE_WORKFLOW:
-            self.workflow.set_desired_state("non-existent")
+            self.workflow.set_desired_state("non-existent", commit)
             if self.workflow.cluster_state != "non-existent":
-                self.progress = self.workflow.progress
-                self.save(update_fields=["progress"])
+                self._set_progress(self.workflow.progress, commit)
             else:
                 if self.phase == self.phases.sim_fin:
-                    self.shift_to_phase(self.phases.fin)
+                    self.shift_to_phase(self.phases.fin, commit)
                 elif self.phase == self.phases.stop_fin:
-                    self.shift_to_phase(self.phases.stopped)
+                    self.shift_to_phase(self.phases.stopped, commit)
 
             return
 
         else:
             return
 
-    def shift_to_phase(self, new_phase):
+    def shift_to_phase(self, new_phase, commit=True):
         self.phase = new_phase
-        self.save(update_fields=["phase"])
+        self._save_or_collect(["phase"], commit)
+
+    def first_scenario(self):
+        # Use prefetched scenarios if available, first() would query again
+        if "scenario" in getattr(self, "_prefetched_objects_cache", {}):
+            scenarios = sorted(self.scenario.all(), key=lambda scenario: scenario.pk)
+            return scenarios[0] if scenarios else None
+        return self.scenario.first()
 
     # INTERNALS
 
@@ -587,24 +850,132 @@ class Scene(models.Model):
                 # Files written by root can't be deleted by django
                 logging.error("Failed to delete working directory")
 
+        # and its export archives
+        cachedir = os.path.join(settings.WORKER_FILEDIR, EXPORT_CACHE_DIRNAME)
+        for archive in glob.glob(os.path.join(cachedir, "{}-*.zip".format(self.suid))):
+            os.remove(archive)
+
     def _update_state_and_save(self):
 
         # TODO: write _update_state_and_save method
         return self.state
 
-    def _local_scan_files(self):
+    def _local_scan_files(self, commit=True, stats=None):
         # scan for files in workingdir based on structure in template info dictionary
-        self.info = scan_output_files(self.workingdir, self.info)
-        self.save(update_fields=["info"])
+        # the scan index keeps the directory mtimes, so only changes are scanned
+        previous = None if commit else copy.deepcopy([self.info, self.scan_index])
+        self.info = scan_output_files(
+            self.workingdir, self.info, self.scan_index, stats
+        )
+        if commit:
+            self._save_or_collect(["info", "scan_index"], commit)
+            return
+
+        changed = [
+            field
+            for field, value in zip(["info", "scan_index"], previous)
+            if getattr(self, field) != value
+        ]
+        if changed:
+            self._save_or_collect(changed, commit)
+
+    def _local_scan_changed_files(self, commit=True, stats=None):
+        """
+        Scan for files only if the output locations changed since the last
+        scan, otherwise count the unchanged scan. Returns whether it scanned.
+        """
+        fingerprint = output_fingerprint(self.workingdir, self.info)
+        if fingerprint == self.scan_fingerprint:
+            self.scan_unchanged += 1
+            self._save_or_collect(["scan_unchanged"], commit)
+            return False
+
+        self._local_scan_files(commit, stats)
+        self.scan_fingerprint = fingerprint
+        self.scan_unchanged = 0
+        self._save_or_collect(["scan_fingerprint", "scan_unchanged"], commit)
+        return True
+
+    def _set_progress(self, progress, commit=True):
+        if commit or self.progress != progress:
+            self.progress = progress
+            self._save_or_collect(["progress"], commit)
+
+    def _save_or_collect(self, fields, commit):
+        if commit:
+            self.save(update_fields=fields)
+        else:
+            # bulk_update skips save(), so collect a new stamp as well
+            if self.changes_stamp(fields):
+                self.stamp = uuid.uuid4()
+                fields = fields + ["stamp"]
+            self.changed_fields = getattr(self, "changed_fields", set()) | set(fields)
+
+    def _update_parameter_values(self):
+        # only write the search values that were added or changed
+        wanted = scene_parameter_values(self.parameters, self.info)
+        existing = {
+            (v.key, v.source, v.numeric_value, v.text_value): v.pk
+            for v in self.parameter_values.all()
+        }
+
+        stale = [pk for value, pk in existing.items() if value not in wanted]
+        if stale:
+            SceneParameterValue.objects.filter(pk__in=stale).delete()
+
+        SceneParameterValue.objects.bulk_create(
+            [
+                SceneParameterValue(
+                    scene=self,
+                    key=key,
+                    source=source,
+                    numeric_value=numeric_value,
+                    text_value=text_value,
+                )
+                for (key, source, numeric_value, text_value) in wanted
+                if (key, source, numeric_value, text_value) not in existing
+            ]
+        )
 
     def __str__(self):
         return self.name
 
 
+class SceneParameterValue(models.Model):
+    """
+    Denormalized search value of a Scene: either the value of an input
+    parameter or a scalar from the postprocessing output. The Scene keeps
+    these rows in sync with its parameters and info, so searches and facets
+    can use the indexes instead of reading every JSON field.
+    """
+
+    SOURCE_CHOICES = (
+        ("input", "Input parameter"),
+        ("postprocess", "Postprocessing output"),
+    )
+
+    scene = models.ForeignKey(
+        Scene, related_name="parameter_values", on_delete=models.CASCADE
+    )
+    key = models.CharField(max_length=256)
+    numeric_value = models.FloatField(blank=True, null=True)
+    text_value = models.CharField(max_length=256, blank=True, null=True)
+    source = models.CharField(max_length=16, choices=SOURCE_CHOICES)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["key", "numeric_value"]),
+            models.Index(fields=["key", "text_value"]),
+        ]
+
+    def __str__(self):
+        return "{} of scene {}".format(self.key, self.scene_id)
+
+
 # ################################### SEARCHFORM & TEMPLATE & WORKFLOW
 
 
-class SearchForm(models.Model):
+class SearchForm(VersionStamped):
 
     """
     SearchForm model:
@@ -725,7 +1096,7 @@ class SearchForm(models.Model):
         return self.name
 
 
-class Template(models.Model):
+class Template(VersionStamped):
 
     """
     Template model
@@ -803,8 +1174,11 @@ class Workflow(models.Model):
     )
 
     # Logging and progress
+    # the logs only keep their latest lines, see WorkflowLogChunk for history
+    LOG_TAIL_LENGTH = 10000
     progress = models.PositiveSmallIntegerField(default=0)
     cluster_log = models.TextField(blank=True, default="")
+    log_cursors = JSONFieldTransition(blank=True, default=dict)  # {pod: timestamp}
     action_log = models.TextField(blank=True, default="")
 
     # Version control
@@ -816,10 +1190,15 @@ class Workflow(models.Model):
             return False
 
     def latest_version(self):
-        try:
-            return self.scene.scenario.first().template.versions.first()
-        except AttributeError:
-            return None
+        # looked up once per workflow object, as the outdated checks
+        # of a single serialization all ask for it
+        if not hasattr(self, "_latest_version"):
+            try:
+                template = self.scene.first_scenario().template
+                self._latest_version = template.versions.first()
+            except AttributeError:
+                self._latest_version = None
+        return self._latest_version
 
     def outdated_changelog(self):
         if self.is_outdated():
@@ -835,28 +1214,38 @@ class Workflow(models.Model):
             return []
 
     # HEARTBEAT METHODS
-    def update_task_result(self):
+    def update_task_result(self, result=None, commit=True):
         """
         Get the result from the last task it executed, given that there is a
         result. If the task is not ready, don't do anything.
+
+        Workflows that share a task can pass its result, so it is read once.
+        With commit=False the changes are not saved, but collected in
+        `changed_fields` for a bulk update.
         """
         if self.task_uuid is None:
             return
 
-        result = AsyncResult(id=str(self.task_uuid))
+        if result is None:
+            result = AsyncResult(id=str(self.task_uuid))
         time_passed = now() - self.task_starttime
         if result.ready():
 
             if result.successful():
                 # Log parsing
                 if "get_kube_log" in result.result:
-                    log = result.result["get_kube_log"]
-
-                    self.cluster_log = merge_log_unique(self.cluster_log, log)
-
-                    progress = log_progress_parser(log, "delft3d")
-                    if progress is not None:
-                        self.progress = math.ceil(progress)
+                    self._parse_log(result.result["get_kube_log"])
+
+                # Log parsing of a task for multiple workflows, which
+                # only returns new lines if it returns log cursors
+                elif "get_kube_logs" in result.result:
+                    log = result.result["get_kube_logs"].get(self.name, "")
+                    cursors = result.result.get("log_cursors", {})
+                    if self.name in cursors:
+                        self._append_log(log)
+                        self.log_cursors = cursors[self.name]
+                    else:
+                        self._parse_log(log)
 
                 else:
                     _ = result.result
@@ -870,7 +1259,9 @@ class Workflow(models.Model):
                 )
 
             self.task_uuid = None
-            self.save(update_fields=["cluster_log", "progress", "task_uuid"])
+            self._save_or_collect(
+                ["cluster_log", "log_cursors", "progress", "task_uuid"], commit
+            )
 
         # Forget task after expire_time
         elif time_passed.total_seconds() > settings.TASK_EXPIRE_TIME:
@@ -881,22 +1272,40 @@ class Workflow(models.Model):
             )
             result.revoke()
             self.task_uuid = None
-            self.save(update_fields=["task_uuid"])
+            self._save_or_collect(["task_uuid"], commit)
 
         else:
             logging.warn("Celery task of {} is still {}.".format(self, result.state))
 
     def sync_cluster_state(self, latest_cluster_state):
+        self.update_cluster_state(latest_cluster_state)
+        self.save(update_fields=["cluster_state"])
+
+    def update_cluster_state(self, latest_cluster_state):
+        """
+        Set the cluster_state from the latest Argo workflow snapshot
+        without saving. Returns whether the cluster_state changed.
+        """
         if latest_cluster_state is None:
+            return self.update_cluster_phase(None)
+        return self.update_cluster_phase(
+            latest_cluster_state["metadata"]["labels"][ARGO_PHASE_LABEL]
+        )
+
+    def update_cluster_phase(self, state):
+        """
+        Set the cluster_state from the latest Argo workflow phase, None if
+        the workflow does not exist, without saving. Returns whether the
+        cluster_state changed.
+        """
+        previous_state = self.cluster_state
+        if state is None:
             self.cluster_state = "non-existent"
         else:
-            state = latest_cluster_state["metadata"]["labels"][
-                "workflows.argoproj.io/phase"
-            ]
             if state == "Failed" or state == "Error":
                 logging.error("{} failed!".format(self.name))
             self.cluster_state = state.lower()
-        self.save(update_fields=["cluster_state"])
+        return self.cluster_state != previous_state
 
     def fix_mismatch_or_log(self):
         """
@@ -929,9 +1338,21 @@ class Workflow(models.Model):
             self.remove_workflow()
 
     # INTERNALS
-    def set_desired_state(self, desired_state):
-        self.desired_state = desired_state
-        self.save(update_fields=["desired_state"])
+    def set_desired_state(self, desired_state, commit=True):
+        if commit:
+            self.desired_state = desired_state
+            self.save(update_fields=["desired_state"])
+        elif self.desired_state != desired_state:
+            self.desired_state = desired_state
+            self.changed_fields = getattr(self, "changed_fields", set()) | {
+                "desired_state"
+            }
+
+    def _save_or_collect(self, fields, commit):
+        if commit:
+            self.save(update_fields=fields)
+        else:
+            self.changed_fields = getattr(self, "changed_fields", set()) | set(fields)
 
     # CELERY TASK CALLS
     def create_workflow(self):
@@ -941,10 +1362,13 @@ class Workflow(models.Model):
             return
 
         # Open and edit workflow Template
-        template_model = self.scene.scenario.first().template
+        template_model = self.scene.first_scenario().template
         with open(template_model.yaml_template.path) as f:
             template = yaml.load(f, Loader=yaml.FullLoader)
-        template["metadata"] = {"name": "{}".format(self.name)}
+        template["metadata"] = {
+            "name": "{}".format(self.name),
+            "labels": dict(settings.ARGO_WORKFLOW_LABELS),
+        }
 
         if self.entrypoint is not None:
             template["spec"]["entrypoint"] = self.entrypoint
@@ -971,7 +1395,7 @@ class Workflow(models.Model):
         )
         self.task_starttime = now()
         self.starttime = now()
-        self.action_log += "{} | Created \n".format(self.task_starttime)
+        self._log_action("{} | Created \n".format(self.task_starttime))
         self.task_uuid = result.id
         self.save(
             update_fields=[
@@ -989,7 +1413,7 @@ class Workflow(models.Model):
         )
         # calculate runtime
         self.stoptime = now()
-        self.action_log += "{} | Stopped \n".format(self.stoptime)
+        self._log_action("{} | Stopped \n".format(self.stoptime))
         self.save(update_fields=["stoptime", "action_log"])
 
     def remove_workflow(self):
@@ -1005,7 +1429,7 @@ class Workflow(models.Model):
         self.task_starttime = now()
         # calculate runtime
         self.stoptime = now()
-        self.action_log += "{} | Removed \n".format(self.stoptime)
+        self._log_action("{} | Removed \n".format(self.stoptime))
 
         self.task_uuid = result.id
         self.save(
@@ -1027,10 +1451,109 @@ class Workflow(models.Model):
         self.task_uuid = result.id
         self.save(update_fields=["task_starttime", "task_uuid"])
 
+    @classmethod
+    def update_logs(cls, workflows):
+        """
+        Request the logs of all given workflows that need one with a single
+        task, which all these workflows share as their task.
+        """
+        workflows = [
+            workflow
+            for workflow in workflows
+            if workflow.task_uuid is None and workflow.cluster_state == "running"
+        ]
+        if not workflows:
+            return
+
+        result = get_kube_logs.apply_async(
+            args=([workflow.name for workflow in workflows],),
+            kwargs={
+                "cursors": {
+                    workflow.name: workflow.log_cursors for workflow in workflows
+                }
+            },
+            expires=settings.TASK_EXPIRE_TIME,
+        )
+        task_starttime = now()
+        for workflow in workflows:
+            workflow.task_starttime = task_starttime
+            workflow.task_uuid = result.id
+        cls.objects.bulk_update(workflows, ["task_starttime", "task_uuid"])
+
+    def _parse_log(self, log):
+        merged = merge_log_unique(self.cluster_log, log)
+        new = (
+            merged[len(self.cluster_log) :]
+            if merged.startswith(self.cluster_log)
+            else log
+        )
+        self._store_log("cluster", new)
+        self.cluster_log = self._log_tail(merged)
+        self._parse_progress(log)
+
+    def _append_log(self, log):
+        # new lines only, no need to find the overlap with the stored log
+        self._store_log("cluster", log)
+        self.cluster_log = self._log_tail(self.cluster_log + log)
+        self._parse_progress(log)
+
+    def _log_action(self, line):
+        self._store_log("action", line)
+        self.action_log = self._log_tail(self.action_log + line)
+
+    def _store_log(self, kind, text):
+        if text:
+            WorkflowLogChunk.objects.create(workflow=self, kind=kind, text=text)
+
+    def _log_tail(self, log):
+        # keep whole lines of the last LOG_TAIL_LENGTH characters
+        if len(log) <= self.LOG_TAIL_LENGTH:
+            return log
+        tail = log[-self.LOG_TAIL_LENGTH :]
+        return tail[tail.find("\n") + 1 :] if "\n" in tail[:-1] else tail
+
+    def log_history(self, kind="cluster", before=None, limit=50):
+        """
+        Return a page of the stored log chunks of the given kind, newest
+        first. Pass the id of the last chunk of a page as before to get
+        the next page.
+        """
+        chunks = self.log_chunks.filter(kind=kind)
+        if before is not None:
+            chunks = chunks.filter(id__lt=before)
+        return list(chunks.order_by("-id")[:limit])
+
+    def _parse_progress(self, log):
+        progress = log_progress_parser(log, "delft3d")
+        if progress is not None:
+            self.progress = math.ceil(progress)
+
     def __str__(self):
         return "Workflow of scene {}".format(self.scene.name)
 
 
+class WorkflowLogChunk(models.Model):
+    """
+    Append-only part of the log of a Workflow, so a log update inserts
+    its new lines instead of rewriting the whole log.
+    """
+
+    KIND_CHOICES = (("cluster", "Cluster log"), ("action", "Action log"))
+
+    workflow = models.ForeignKey(
+        Workflow, on_delete=models.CASCADE, related_name="log_chunks"
+    )
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES, default="cluster")
+    date_created = models.DateTimeField(default=tz_now)
+    text = models.TextField()
+
+    class Meta:
+        indexes = [models.Index(fields=["workflow", "kind", "id"])]
+
+    def __str__(self):
+        return "{} log of {}".format(self.kind, self.workflow.name)
+
+
 class GroupUsageSummary(Group):
     class Meta:
         proxy = True
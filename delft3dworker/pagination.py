@@ -0,0 +1,104 @@
+"""
+Pagination for the scene and scenario list endpoints.
+"""
+from __future__ import absolute_import
+
+import json
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connections
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+
+
+def estimate_count(queryset):
+    """
+    Return the number of rows the database planner expects the queryset
+    to return, without counting them. Only PostgreSQL is asked for its
+    estimate, other databases count the rows.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != "postgresql":
+        return queryset.count()
+
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN (FORMAT JSON) {}".format(sql), params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+class EstimatedCountCursorPagination(CursorPagination):
+    """
+    Cursor pagination over the primary key, so every page is an index
+    range scan no matter how deep the client pages.
+
+    Lists are only paginated when the client asks for it with a `cursor`
+    or `page_size` query parameter, so existing clients keep receiving a
+    plain list. The `count` is exact up to API_EXACT_COUNT_LIMIT objects,
+    beyond it the database estimate is returned and `count_estimated` is
+    set.
+    """
+
+    ordering = "id"
+    page_size_query_param = "page_size"
+
+    # Orderings backed by an index, other orderings fall back to `ordering`
+    cursor_fields = ("id",)
+
+    def get_page_size(self, request):
+        query_params = request.query_params
+        if (
+            self.cursor_query_param not in query_params
+            and self.page_size_query_param not in query_params
+        ):
+            return None
+
+        self.page_size = settings.API_PAGE_SIZE
+        self.max_page_size = settings.API_MAX_PAGE_SIZE
+        return super().get_page_size(request)
+
+    def get_ordering(self, request, queryset, view):
+        ordering = super().get_ordering(request, queryset, view)
+        if ordering[0].lstrip("-") not in self.cursor_fields:
+            return (self.ordering,)
+        return ordering
+
+    def paginate_queryset(self, queryset, request, view=None):
+        page = super().paginate_queryset(queryset, request, view)
+        if page is not None:
+            self.count, self.count_estimated = self.get_count(queryset)
+        return page
+
+    def get_count(self, queryset):
+        """
+        Return the number of objects in the queryset and whether it is
+        estimated. Counting stops at API_EXACT_COUNT_LIMIT objects.
+        """
+        limit = settings.API_EXACT_COUNT_LIMIT
+        count = queryset.order_by()[: limit + 1].count()
+        if count <= limit:
+            return count, False
+        return max(estimate_count(queryset), count), True
+
+    def get_paginated_response(self, data):
+        return Response(
+            OrderedDict(
+                [
+                    ("next", self.get_next_link()),
+                    ("previous", self.get_previous_link()),
+                    ("count", self.count),
+                    ("count_estimated", self.count_estimated),
+                    ("results", data),
+                ]
+            )
+        )
+
+    def get_paginated_response_schema(self, schema):
+        schema = super().get_paginated_response_schema(schema)
+        schema["properties"]["count"] = {"type": "integer", "example": 123}
+        schema["properties"]["count_estimated"] = {"type": "boolean"}
+        return schema
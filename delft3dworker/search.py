@@ -0,0 +1,128 @@
+"""
+Compile scene search parameters into database lookups.
+"""
+from __future__ import absolute_import
+
+import logging
+
+from django.db.models import Count, Max, Min
+
+from delft3dworker.models import SceneParameterValue
+
+
+def parse_parameter(parameter):
+    """
+    Split a `parameter` query value into its key and values.
+
+    Possible values:
+        # filters on key occurance (ignored)
+        - "parameter"
+        # filters on key occurance and value
+        - "parameter,value"
+        # filters on key occurance and value between min & max
+        - "parameter,minvalue,maxvalue"
+        # filters on key occurance and one of the values
+        - "parameter,value,value,value"
+
+    :param parameter: comma separated string from the query
+    :return: tuple of key, (minvalue, maxvalue) or None and list of values
+    """
+    p = [val for val in parameter.split(",") if val != ""]
+    if len(p) < 2:
+        return None, None, []
+
+    key, values = p[0], p[1:]
+
+    # Key, min, max lookup
+    if len(values) == 2:
+        try:
+            return key, (float(values[0]), float(values[1])), values
+        except ValueError:
+            pass  # no floats? match on values instead
+
+    # The front-end is supposed to provide sediment
+    # compositions as follows:
+    #
+    # ...?parameter=composition,sand-clay&parameter=composition,mud
+    #
+    # however, now it provides it as follows:
+    #
+    # ...?parameter=composition,sand-clay,mud
+    #
+    # hence every other amount of values is a list of wanted values
+    return key, None, values
+
+
+def filter_scenes_by_parameters(queryset, parameters):
+    """
+    Restrict a Scene queryset to the given `parameter` query values.
+
+    All filters are answered by the indexed SceneParameterValue table, so
+    no scene is loaded to evaluate them. A range matches either the input
+    parameter value or the postprocessing output with the same key. Non
+    numeric values never match a range.
+    """
+    for parameter in parameters:
+        key, bounds, values = parse_parameter(parameter)
+        if key is None:
+            continue
+
+        if bounds is not None:
+            minvalue, maxvalue = bounds
+            logging.info(
+                "Lookup value [{} - {}] for parameter {}".format(
+                    minvalue, maxvalue, key
+                )
+            )
+            wanted = SceneParameterValue.objects.filter(
+                key=key, numeric_value__gte=minvalue, numeric_value__lte=maxvalue
+            )
+
+        else:
+            logging.info("Lookup value for parameter {}".format(key))
+            wanted = SceneParameterValue.objects.filter(
+                key=key, source="input", text_value__in=values
+            )
+
+        queryset = queryset.filter(pk__in=wanted.values("scene_id"))
+
+    return queryset
+
+
+def parameter_facets(queryset):
+    """
+    Summarize the search values of the scenes in the given queryset.
+
+    :param queryset: Scene queryset
+    :return: dict with for each key the numeric range and scene count
+             and the scene count per text value
+    """
+    values = SceneParameterValue.objects.filter(
+        scene__in=queryset.values("pk")
+    ).order_by()
+    facets = {}
+
+    numeric = (
+        values.exclude(numeric_value=None)
+        .values("key")
+        .annotate(
+            min=Min("numeric_value"),
+            max=Max("numeric_value"),
+            count=Count("scene", distinct=True),
+        )
+    )
+    for row in numeric:
+        facets.setdefault(row["key"], {"values": {}}).update(
+            {"min": row["min"], "max": row["max"], "count": row["count"]}
+        )
+
+    text = (
+        values.exclude(text_value=None)
+        .values("key", "text_value")
+        .annotate(count=Count("scene", distinct=True))
+    )
+    for row in text:
+        facet = facets.setdefault(row["key"], {"values": {}})
+        facet["values"][row["text_value"]] = row["count"]
+
+    return facets
@@ -1,7 +1,14 @@
 from django.contrib.auth.models import Group, User
 from rest_framework import serializers
 
-from delft3dworker.models import Scenario, Scene, SearchForm, Template, Version_Docker
+from delft3dworker.models import (
+    Scenario,
+    Scene,
+    SearchForm,
+    Template,
+    Version_Docker,
+    WorkflowLogChunk,
+)
 
 
 class VersionSerializer(serializers.ModelSerializer):
@@ -102,7 +109,7 @@ class SceneFullSerializer(serializers.ModelSerializer):
             return None
 
     def get_template(self, obj):
-        scenario = obj.scenario.first()
+        scenario = obj.first_scenario()
         # Only retrieve template in case of a connected scenario
         if scenario is not None and scenario.template is not None:
             return scenario.template.name
@@ -135,7 +142,7 @@ class SceneSparseSerializer(serializers.ModelSerializer):
         )
 
     def get_template_name(self, obj):
-        scenario = obj.scenario.first()
+        scenario = obj.first_scenario()
         # Only retrieve template in case of a connected scenario
         if scenario is not None and scenario.template is not None:
             return scenario.template.name
@@ -150,7 +157,8 @@ class ScenarioSerializer(serializers.ModelSerializer):
     """
 
     # here we will write custom serialization and validation methods
-    state = serializers.CharField(source="_update_state_and_save", read_only=True)
+    state = serializers.CharField(source="current_state", read_only=True)
+    progress = serializers.IntegerField(source="current_progress", read_only=True)
 
     owner_url = serializers.HyperlinkedRelatedField(
         read_only=True, view_name="user-detail", source="owner"
@@ -204,3 +212,19 @@ class TemplateSerializer(serializers.ModelSerializer):
             "meta",
             "sections",
         )
+
+
+class WorkflowLogChunkSerializer(serializers.ModelSerializer):
+    """
+    A default REST Framework ModelSerializer for the WorkflowLogChunk model
+    source: http://www.django-rest-framework.org/api-guide/serializers/
+    """
+
+    class Meta:
+        model = WorkflowLogChunk
+        fields = (
+            "id",
+            "kind",
+            "date_created",
+            "text",
+        )
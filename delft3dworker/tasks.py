@@ -0,0 +1,50 @@
+from __future__ import absolute_import
+
+import logging
+
+from celery import shared_task
+from celery_once import QueueOnce
+from django.contrib.auth.models import User
+from django.core.management import call_command
+
+from delft3dworker.models import Scenario, Scene
+
+
+@shared_task(bind=True)
+def create_scenario_scenes(self, scenario_id, user_id):
+    """
+    Create the scenes of a new scenario in the background, so large
+    parameter sweeps don't hold up the request.
+    """
+    scenario = Scenario.objects.get(pk=scenario_id)
+    user = User.objects.get(pk=user_id)
+    try:
+        scenario.materialize(user)
+    except Exception:
+        # don't leave the scenario MATERIALIZING forever
+        logging.exception("Creating scenes of scenario {} failed".format(scenario_id))
+        scenario.state = Scenario.FAILED
+        scenario.save(update_fields=["state"])
+        raise
+
+    return {"create_scenario_scenes": scenario_id}
+
+
+@shared_task(bind=True, base=QueueOnce, once={"graceful": True})
+def build_export_archive(self, scene_id, options):
+    """
+    Build the export archive of a finished scene for the given options,
+    which the export view serves once it exists. An archive being built
+    is not queued again while the client waits for it.
+    """
+    scene = Scene.objects.get(pk=scene_id)
+    return {"build_export_archive": scene.export_archive(options)}
+
+
+@shared_task(bind=True, base=QueueOnce, once={"graceful": True})
+def delft3dgt_build_exports(self):
+    """
+    This task runs the build_exports management command, which keeps the
+    export archives of finished scenes up to date.
+    """
+    return call_command("build_exports")
@@ -1,14 +1,31 @@
 from __future__ import absolute_import
 
+import os
+import shutil
+import tempfile
+
 # from StringIO import StringIO
 from io import StringIO
 
+from celery.exceptions import TimeoutError
+from django.conf import settings
 from django.core.management import call_command
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from fakeredis import FakeStrictRedis
+from kubernetes.client.rest import ApiException
 from mock import PropertyMock, call, patch
 
+from delft3dworker.management.commands.sync_cluster_state import (
+    Command as SyncCommand,
+)
+from delft3dworker.management.commands.watch_workflows import (
+    WATCH_BACKOFF,
+    Command as WatchCommand,
+)
 from delft3dworker.models import Scenario, Scene, Template, Workflow
+from delft3dworker.tasks import delft3dgt_build_exports
 
 
 class ManagementTest(TestCase):
@@ -51,9 +68,112 @@ class ManagementTest(TestCase):
         call_command("scanbucket")
         self.assertEqual(mocklocalscan.call_count, 1)
 
+    def test_scanbucket_command_saves_updates(self):
+        info = {"logfile": {"extensions": [".log"], "files": [], "location": "sim/"}}
+        workingdir = tempfile.mkdtemp()
+        Scene.objects.filter(pk=self.scene_new.pk).update(
+            info=info, workingdir=workingdir
+        )
+        logdir = os.path.join(workingdir, "sim")
+        os.makedirs(logdir)
+        open(os.path.join(logdir, "delft3d.log"), "a").close()
+
+        out = StringIO()
+        call_command("scanbucket", "--dry-run", "--workers=2", stdout=out)
+        self.assertIn("[dry run] Checked 1 scenes, scanned 1", out.getvalue())
+        self.assertIn("updated 1 scenes", out.getvalue())
+        self.scene_new.refresh_from_db()
+        self.assertEqual(self.scene_new.info["logfile"]["files"], [])
+
+        out = StringIO()
+        call_command("scanbucket", "--workers=2", stdout=out)
+        self.scene_new.refresh_from_db()
+        self.assertEqual(self.scene_new.info["logfile"]["files"], ["delft3d.log"])
+        self.assertIn("logfile", self.scene_new.scan_index)
+        stamp = self.scene_new.stamp
+
+        # unchanged output is not scanned again, until the scene is settled
+        call_command("scanbucket", "--settle-after=2", stdout=StringIO())
+        out = StringIO()
+        call_command("scanbucket", "--settle-after=2", stdout=out)
+        self.assertIn("Checked 1 scenes, scanned 0", out.getvalue())
+        self.scene_new.refresh_from_db()
+        self.assertEqual(self.scene_new.scan_unchanged, 2)
+
+        # counting unchanged scans keeps the scene current for clients
+        self.assertEqual(self.scene_new.stamp, stamp)
+        self.scene_new.save(update_fields=["scan_unchanged"])
+        self.scene_new.refresh_from_db()
+        self.assertEqual(self.scene_new.stamp, stamp)
+        self.scene_new.save(update_fields=["progress"])
+        self.scene_new.refresh_from_db()
+        self.assertNotEqual(self.scene_new.stamp, stamp)
+
+        out = StringIO()
+        call_command("scanbucket", "--settle-after=2", stdout=out)
+        self.assertIn("Checked 0 scenes", out.getvalue())
+
+        # new output is scanned when settled scenes are included
+        open(os.path.join(logdir, "delft3d-2.log"), "a").close()
+        call_command("scanbucket", "--include-settled", stdout=StringIO())
+        self.scene_new.refresh_from_db()
+        self.assertEqual(len(self.scene_new.info["logfile"]["files"]), 2)
+        self.assertEqual(self.scene_new.scan_unchanged, 0)
+
+        shutil.rmtree(workingdir)
+
+    @patch(
+        "delft3dworker.management.commands." "build_exports.Scene.export_archive",
+        return_value="exports/archive.zip",
+    )
+    def test_build_exports_command(self, mockexport):
+        self.template.export_options = {"export_images": {}, "export_thirdparty": {}}
+        self.template.save()
+
+        self.scene_new.scan_fingerprint = "abc"
+        self.scene_new.save()
+
+        out = StringIO()
+        call_command("build_exports", stdout=out)
+
+        # only the finished scene, once per export option
+        mockexport.assert_has_calls(
+            [call(["export_images"]), call(["export_thirdparty"])], any_order=True
+        )
+        self.assertIn("Export archives built: 2", out.getvalue())
+        self.scene_new.refresh_from_db()
+        self.assertEqual(self.scene_new.export_fingerprint, "abc")
+
+        # until scanbucket finds new output the scene is not visited again
+        mockexport.reset_mock()
+        call_command("build_exports", stdout=StringIO())
+        mockexport.assert_not_called()
+
+        self.scene_new.scan_fingerprint = "def"
+        self.scene_new.save()
+        call_command("build_exports", stdout=StringIO())
+        self.assertEqual(mockexport.call_count, 2)
+
+    @patch("delft3dworker.tasks.call_command")
+    def test_build_exports_scheduled(self, mocked_command):
+        schedule = settings.CELERY_BEAT_SCHEDULE["build_exports"]
+        self.assertEqual(schedule["task"], delft3dgt_build_exports.name)
+
+        delft3dgt_build_exports()
+        mocked_command.assert_called_once_with("build_exports")
+
+    def test_backfill_parameter_values_command(self):
+        Scene.objects.filter(pk=self.scene.pk).update(parameters={"a": {"value": 1}})
+        self.assertEqual(self.scene.parameter_values.count(), 0)
+
+        out = StringIO()
+        call_command("backfill_parameter_values", stdout=out)
+        self.assertEqual(self.scene.parameter_values.count(), 1)
+        self.assertIn("Updated search values of 2 scenes.", out.getvalue())
+
     @patch(
         "delft3dworker.management.commands."
-        "sync_cluster_state.Workflow.sync_cluster_state"
+        "sync_cluster_state.Workflow.update_cluster_phase"
     )
     @patch(
         "delft3dworker.management.commands." "sync_cluster_state.get_argo_workflows",
@@ -75,9 +195,11 @@ class ManagementTest(TestCase):
         # test-template-orphan is not known, but has known shortname and should be removed
         # other-test-run is not known and has no known shortname and should be ignored
         mockWorkflows.apply_async().result = {
-            "get_argo_workflows": """{"items":[{"metadata":{"name":"test-template-abcdefg", "labels": {"workflows.argoproj.io/phase": "Running"}}},
-                               {"metadata":{"name":"test-template-orphan", "labels": {"workflows.argoproj.io/phase": "Running"}}},
-                               {"metadata":{"name":"other-test-run", "labels": {"workflows.argoproj.io/phase": "Running"}}}]}"""
+            "get_argo_workflows": {
+                "test-template-abcdefg": "Running",
+                "test-template-orphan": "Running",
+                "other-test-run": "Running",
+            }
         }
 
         out = StringIO()
@@ -92,21 +214,238 @@ class ManagementTest(TestCase):
         # workflow in database
         self.assertEqual(mockWorkflowupdate.call_count, 2)
         mockWorkflowupdate.assert_has_calls(
-            [
-                call(
-                    {
-                        "metadata": {
-                            "name": "test-template-abcdefg",
-                            "labels": {u"workflows.argoproj.io/phase": "Running"},
-                        }
-                    }
-                ),
-                call(None),
-            ],
-            any_order=True,
+            [call("Running"), call(None)], any_order=True
         )
         self.assertEqual(mockWorkflowremove.delay.call_count, 1)
 
+    @patch(
+        "delft3dworker.management.commands." "sync_cluster_state.Workflow.update_logs"
+    )
+    @patch(
+        "delft3dworker.management.commands." "sync_cluster_state.Workflow.fix_mismatch"
+    )
+    @patch(
+        "delft3dworker.management.commands." "sync_cluster_state.get_argo_workflows",
+        **mock_options
+    )
+    def test_sync_cluster_state_writes_changes(self, mockWorkflows, mockFix, mockLogs):
+        """
+        Test the heartbeat writes changed states and phases in bulk
+        """
+        mockWorkflows.apply_async().result = {
+            "get_argo_workflows": {"test-template-abcdefg": "Running"}
+        }
+
+        call_command("sync_cluster_state", stderr=StringIO())
+
+        self.workflow_1_1.refresh_from_db()
+        self.workflow_1_1_new.refresh_from_db()
+        self.scene.refresh_from_db()
+        self.assertEqual(self.workflow_1_1.cluster_state, "running")
+        self.assertEqual(self.workflow_1_1_new.cluster_state, "non-existent")
+        self.assertEqual(self.scene.phase, Scene.phases.idle)
+
+        # a second heartbeat without changes writes nothing
+        with CaptureQueriesContext(connection) as context:
+            call_command("sync_cluster_state", stderr=StringIO())
+        self.assertFalse(
+            [q for q in context.captured_queries if q["sql"].startswith("UPDATE")]
+        )
+
+    @patch(
+        "delft3dworker.management.commands." "sync_cluster_state.AsyncResult",
+        **mock_options
+    )
+    def test_sync_cluster_state_shared_task_result(self, mockResult):
+        """
+        Test the result of a task for multiple workflows is read once
+        """
+        task_uuid = "1c1c7a4b-47ba-4d3c-9a1b-1f3c1a3b2d4e"
+        Workflow.objects.update(task_uuid=task_uuid)
+        mockResult.return_value.ready.return_value = True
+        mockResult.return_value.successful.return_value = True
+        mockResult.return_value.result = {
+            "get_kube_logs": {
+                "test-template-abcdefg": "first\n",
+                "bar": "second\n",
+            },
+            "log_cursors": {"test-template-abcdefg": {"main": "t1"}, "bar": {}},
+        }
+
+        SyncCommand()._update_workflow_tasks()
+
+        mockResult.assert_called_once_with(id=task_uuid)
+        self.workflow_1_1.refresh_from_db()
+        self.workflow_1_1_new.refresh_from_db()
+        self.assertEqual(self.workflow_1_1.cluster_log, "first\n")
+        self.assertEqual(self.workflow_1_1.log_cursors, {"main": "t1"})
+        self.assertEqual(self.workflow_1_1_new.cluster_log, "second\n")
+        self.assertIsNone(self.workflow_1_1.task_uuid)
+        self.assertIsNone(self.workflow_1_1_new.task_uuid)
+
+    @patch(
+        "delft3dworker.management.commands." "sync_cluster_state.Workflow.update_logs"
+    )
+    @patch(
+        "delft3dworker.management.commands." "sync_cluster_state.Workflow.fix_mismatch"
+    )
+    @patch(
+        "delft3dworker.management.commands."
+        "sync_cluster_state.Scene.update_and_phase_shift"
+    )
+    @patch(
+        "delft3dworker.management.commands." "sync_cluster_state.get_argo_workflows",
+        **mock_options
+    )
+    def test_sync_cluster_state_active_set(
+        self, mockWorkflows, mockUpdate, mockFix, mockLogs
+    ):
+        """
+        Test only scenes in an active phase are reconciled
+        """
+        mockWorkflows.apply_async().result = {"get_argo_workflows": {}}
+
+        call_command("sync_cluster_state", stderr=StringIO())
+
+        # scene_new is finished and its workflow settled
+        self.assertEqual(mockUpdate.call_count, 1)
+        self.assertEqual(mockFix.call_count, 1)
+
+        # and logs are requested once for all workflows
+        self.assertEqual(mockLogs.call_count, 1)
+        self.assertEqual(
+            [workflow.name for workflow in mockLogs.call_args[0][0]],
+            [self.workflow_1_1.name],
+        )
+
+    @patch(
+        "delft3dworker.management.commands."
+        "sync_cluster_state.Command._update_scene_phases"
+    )
+    @patch(
+        "delft3dworker.management.commands." "sync_cluster_state.get_argo_workflows",
+        **mock_options
+    )
+    def test_sync_cluster_state_timeout(self, mockWorkflows, mockPhases):
+        """
+        Test the heartbeat waits for the cluster workflows without polling
+        and gives up when they take too long
+        """
+        mockWorkflows.apply_async().get.side_effect = TimeoutError
+
+        call_command("sync_cluster_state", stderr=StringIO())
+
+        self.assertEqual(mockWorkflows.apply_async().get.call_count, 1)
+        self.assertEqual(mockWorkflows.apply_async().revoke.call_count, 1)
+        self.assertEqual(mockPhases.call_count, 0)
+
+        # a failed task is not waited for any longer
+        mockWorkflows.apply_async().get.side_effect = None
+        mockWorkflows.apply_async().successful.return_value = False
+
+        call_command("sync_cluster_state", stderr=StringIO())
+
+        self.assertEqual(mockWorkflows.apply_async().get.call_count, 2)
+        self.assertEqual(mockPhases.call_count, 0)
+
+    @override_settings(ARGO_WORKFLOW_WATCH=True)
+    @patch(
+        "delft3dworker.management.commands." "sync_cluster_state.Workflow.update_logs"
+    )
+    @patch(
+        "delft3dworker.management.commands." "sync_cluster_state.Workflow.fix_mismatch"
+    )
+    @patch(
+        "delft3dworker.management.commands." "sync_cluster_state.get_argo_workflows",
+        **mock_options
+    )
+    def test_sync_cluster_state_watched(self, mockWorkflows, mockFix, mockLogs):
+        """
+        Test the heartbeat does not list watched workflows
+        """
+        call_command("sync_cluster_state", stderr=StringIO())
+
+        # but scene phases still follow the watched states
+        self.assertEqual(mockWorkflows.apply_async.call_count, 0)
+        self.scene.refresh_from_db()
+        self.assertEqual(self.scene.phase, Scene.phases.idle)
+
+    @patch(
+        "delft3dworker.management.commands." "sync_cluster_state.do_argo_remove",
+        **mock_options
+    )
+    @patch(
+        "delft3dworker.management.commands." "watch_workflows.delft3dgt_kube_pulse",
+        **mock_options
+    )
+    @patch("delft3dworker.management.commands." "watch_workflows.sleep")
+    @patch("delft3dworker.management.commands." "watch_workflows.watch.Watch")
+    @patch("delft3dworker.management.commands." "watch_workflows.client")
+    @patch("delft3dworker.management.commands." "watch_workflows.api_client")
+    def test_watch_workflows(
+        self, mockClient, mockKube, mockWatch, mockSleep, mockPulse, mockWorkflowremove
+    ):
+        """
+        Test workflow states follow a watch stream after the initial list
+        """
+
+        def workflow(name, phase=None, resource_version="1"):
+            metadata = {"name": name, "resourceVersion": resource_version}
+            if phase is not None:
+                metadata["labels"] = {"workflows.argoproj.io/phase": phase}
+            return {"metadata": metadata}
+
+        mockKube.CustomObjectsApi().list_cluster_custom_object.return_value = {
+            "metadata": {"resourceVersion": "10"},
+            "items": [
+                workflow("test-template-abcdefg", "Pending"),
+                workflow("bar", "Succeeded"),
+            ],
+        }
+        events = [
+            ("MODIFIED", workflow("test-template-abcdefg", "Running", "11")),
+            ("ADDED", workflow("test-template-orphan", "Running", "12")),
+            ("MODIFIED", workflow("bar", None, "13")),
+            ("BOOKMARK", {"metadata": {"resourceVersion": "14"}}),
+            ("DELETED", workflow("bar", "Succeeded", "15")),
+        ]
+        mockWatch().stream.return_value = iter(
+            [{"type": kind, "raw_object": obj} for kind, obj in events]
+        )
+
+        call_command("watch_workflows", "--once", stderr=StringIO())
+
+        # the watch resumes from the listed resourceVersion
+        self.assertEqual(mockWatch().stream.call_args[1]["resource_version"], "10")
+        self.workflow_1_1.refresh_from_db()
+        self.workflow_1_1_new.refresh_from_db()
+        self.assertEqual(self.workflow_1_1.cluster_state, "running")
+        self.assertEqual(self.workflow_1_1_new.cluster_state, "non-existent")
+        mockWorkflowremove.delay.assert_called_once_with("test-template-orphan")
+
+        # one sync for the list and one per changed workflow
+        self.assertEqual(mockPulse.apply_async.call_count, 3)
+
+        # an expired resourceVersion is listed again
+        mockWatch().stream.side_effect = ApiException(status=410)
+        call_command("watch_workflows", "--once", stderr=StringIO())
+
+        # also when it arrives as an ERROR event with a Status
+        def error(code):
+            status = {"kind": "Status", "code": code, "message": "failed"}
+            return iter([{"type": "ERROR", "raw_object": status}])
+
+        mockWatch().stream.side_effect = None
+        mockWatch().stream.return_value = error(410)
+        mockSleep.reset_mock()
+        self.assertIsNone(WatchCommand()._watch_workflows("15", 60))
+        mockSleep.assert_not_called()
+
+        # other errors resume from the same resourceVersion after a while
+        mockWatch().stream.return_value = error(500)
+        self.assertEqual(WatchCommand()._watch_workflows("15", 60), "15")
+        mockSleep.assert_called_once_with(WATCH_BACKOFF)
+
     def tearDown(self):
         self.redis.flushall()
         self.get_redis.stop()
@@ -3,6 +3,8 @@ from __future__ import absolute_import
 import io
 import json
 import os
+import shutil
+import tempfile
 import uuid
 import zipfile
 from datetime import timedelta
@@ -11,12 +13,15 @@ import yaml
 from django.conf import settings
 from django.contrib.auth.models import Group, Permission, User
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils.timezone import now
 from guardian.shortcuts import assign_perm, get_objects_for_user
 from mock import Mock, patch
 
 from delft3dworker.models import Scenario, Scene, Template, Version_Docker, Workflow
+from delft3dworker.tasks import create_scenario_scenes
 from delft3dworker.utils import tz_now
 
 
@@ -82,6 +87,78 @@ class ScenarioTestCase(TestCase):
         self.assertIn(self.scenario_A, scene.scenario.all())
         self.assertIn(self.scenario_B, scene.scenario.all())
 
+    def test_createscenes_bulk(self):
+        """Test scenes of a sweep are created in a fixed number of queries."""
+
+        def create(scenario, values):
+            scenario.load_settings({"basinslope": {"values": values}})
+            with CaptureQueriesContext(connection) as context:
+                scenario.createscenes(self.user_foo)
+            return len(context.captured_queries)
+
+        create(self.scenario_single, [0.01, 0.02])
+        many = create(self.scenario_multi, [0.1 * i for i in range(1, 31)])
+        few = create(self.scenario_B, [0.04, 0.05])
+        self.assertEqual(few, many)
+        self.assertEqual(self.scenario_multi.scene_set.count(), 30)
+
+        # new scenes are complete, as if saved one by one
+        scene = self.scenario_multi.scene_set.get(name="Test multiple scenes: Run 2")
+        self.assertEqual(scene.parameters["basinslope"]["value"], 0.2)
+        self.assertEqual(
+            scene.workingdir, os.path.join(settings.WORKER_FILEDIR, str(scene.suid), "")
+        )
+        self.assertTrue(
+            scene.parameter_values.filter(key="basinslope", numeric_value=0.2).exists()
+        )
+        for perm in ["add_scene", "change_scene", "delete_scene", "view_scene"]:
+            self.assertTrue(self.user_foo.has_perm(perm, scene))
+        self.assertTrue(self.user_foo.has_perm("extended_view_scene", scene))
+
+        # clones are shared, also within a sweep
+        create(self.scenario_A, [0.02, 0.03, 0.03])
+        self.assertEqual(self.scenario_A.scene_set.count(), 2)
+        self.assertEqual(Scene.objects.count(), 35)
+        clone = self.scenario_single.scene_set.get(name="Test single scene: Run 2")
+        self.assertIn(self.scenario_A, clone.scenario.all())
+
+    def test_materialize(self):
+        """Test scenes are created in chunks while materializing."""
+        self.scenario_multi.state = Scenario.MATERIALIZING
+        self.scenario_multi.load_settings(
+            {"basinslope": {"values": [0.01, 0.02, 0.03, 0.04, 0.05]}}
+        )
+        self.assertEqual(self.scenario_multi.current_state(), Scenario.MATERIALIZING)
+
+        with patch.object(
+            Scenario, "_createscenes", autospec=True, side_effect=Scenario._createscenes
+        ) as mocked_create:
+            self.scenario_multi.materialize(self.user_foo, chunk_size=2)
+        self.assertEqual(
+            [c[0][2:] for c in mocked_create.call_args_list], [(0, 2), (2, 4), (4, 6)]
+        )
+
+        self.scenario_multi.refresh_from_db()
+        self.assertEqual(self.scenario_multi.state, "CREATED")
+        self.assertEqual(
+            sorted(self.scenario_multi.scene_set.values_list("name", flat=True)),
+            ["Test multiple scenes: Run {}".format(i) for i in range(1, 6)],
+        )
+
+    def test_materialize_failed(self):
+        """Test a scenario is not left materializing when creation fails."""
+        self.scenario_multi.state = Scenario.MATERIALIZING
+        self.scenario_multi.load_settings({"basinslope": {"values": [0.01]}})
+
+        with patch.object(
+            Scenario, "_createscenes", autospec=True, side_effect=ValueError
+        ):
+            with self.assertRaises(ValueError):
+                create_scenario_scenes(self.scenario_multi.pk, self.user_foo.pk)
+
+        self.scenario_multi.refresh_from_db()
+        self.assertEqual(self.scenario_multi.current_state(), Scenario.FAILED)
+
 
 class ScenarioControlTestCase(TestCase):
     def setUp(self):
@@ -504,6 +581,62 @@ class SceneTestCase(TestCase):
         zf.close()
 
 
+class SceneExportArchiveTestCase(TestCase):
+    def setUp(self):
+        self.filedir = tempfile.mkdtemp()
+        self.filedir_settings = override_settings(WORKER_FILEDIR=self.filedir)
+        self.filedir_settings.enable()
+
+        template = Template.objects.create(
+            name="Template parent",
+            export_options={
+                "export_thirdparty": {"extensions": [".gz"], "location": "export"},
+            },
+        )
+        scenario = Scenario.objects.create(name="Scenario parent", template=template)
+        self.scene_1 = Scene.objects.create(name="Scene 1", phase=Scene.phases.fin)
+        self.scene_1.scenario.set([scenario])
+
+        os.makedirs(os.path.join(self.scene_1.workingdir, "export"))
+        open(os.path.join(self.scene_1.workingdir, "export", "export.gz"), "a").close()
+
+    def tearDown(self):
+        self.filedir_settings.disable()
+        shutil.rmtree(self.filedir)
+
+    def test_export_archive(self):
+        # No files
+        self.assertIsNone(self.scene_1.export_archive([]))
+
+        # The path is known before the archive is built
+        expected = self.scene_1.export_archive_path(["export_thirdparty"])
+        self.assertFalse(os.path.exists(os.path.join(self.filedir, expected)))
+
+        archive = self.scene_1.export_archive(["export_thirdparty"])
+        self.assertEqual(archive, expected)
+        path = os.path.join(settings.WORKER_FILEDIR, archive)
+        zf = zipfile.ZipFile(path)
+        self.assertEqual(len(zf.namelist()), 1)
+        zf.close()
+
+        # Archive is reused while files are unchanged
+        self.assertEqual(self.scene_1.export_archive(["export_thirdparty"]), archive)
+
+        # and replaced when they change
+        export_file = os.path.join(self.scene_1.workingdir, "export", "export.gz")
+        with open(export_file, "a") as f:
+            f.write("changed")
+        new_archive = self.scene_1.export_archive(["export_thirdparty"])
+        self.assertNotEqual(new_archive, archive)
+        self.assertFalse(os.path.exists(path))
+
+        # and removed with the scene files
+        self.scene_1._delete_datafolder()
+        self.assertFalse(
+            os.path.exists(os.path.join(settings.WORKER_FILEDIR, new_archive))
+        )
+
+
 class ScenarioZeroPhaseTestCase(TestCase):
     def test_phase_00(self):
         self.template = Template.objects.create(name="Template parent")
@@ -716,6 +849,25 @@ class ScenarioPhasesTestCase(TestCase):
         self.scene_1.update_and_phase_shift()
         self.assertEqual(self.scene_1.phase, self.p.sim_fin)
 
+    def test_parameter_values(self):
+        """Search values follow the scene parameters and scanned output"""
+        self.scene_1._local_scan_files()
+        values = self.scene_1.parameter_values.filter(source="postprocess")
+        self.assertEqual(
+            set(values.values_list("key", "numeric_value")),
+            {(k, v) for k, v in self.cleaned_data.items() if v is not None},
+        )
+
+        self.scene_1.parameters = {"basinslope": {"value": 0.0143}}
+        self.scene_1.save()
+        self.scene_1.parameters = {"basinslope": {"value": 0.0145}}
+        self.scene_1.save()
+        values = self.scene_1.parameter_values.filter(source="input")
+        self.assertEqual(
+            list(values.values_list("key", "numeric_value")),
+            [("basinslope", 0.0145)],
+        )
+
     def test_phase_sim_fin(self):
         self.scene_1.phase = self.p.sim_fin
 
@@ -841,6 +993,14 @@ class WorkflowTestCase(TestCase):
         # Version 2 is newer than connected Version
         self.assertEqual(self.workflow.latest_version(), self.version2)
 
+        # and is looked up once for all outdated checks
+        workflow = Workflow.objects.select_related("version").get(pk=self.workflow.pk)
+        workflow.latest_version()
+        with self.assertNumQueries(0):
+            workflow.is_outdated()
+            workflow.outdated_changelog()
+            workflow.outdated_entrypoints()
+
     def test_outdated_changelog(self):
         # Version 2 is newer than connected Version
         self.assertEqual(self.workflow.outdated_changelog(), self.version2.changelog)
@@ -921,7 +1081,7 @@ class WorkflowTestCase(TestCase):
         self.workflow.task_starttime = now()
         async_result.ready.return_value = True
         async_result.state = "SUCCESS"
-        async_result.result = "dockerid", u"None"
+        async_result.result = "dockerid", "None"
         async_result.successful.return_value = True
 
         # call method
@@ -948,6 +1108,56 @@ class WorkflowTestCase(TestCase):
         # check progress changed
         self.assertEqual(self.workflow.progress, 56.0)
 
+        # Set up: task for multiple workflows is finished
+        self.workflow.task_uuid = uuid.UUID("6764743a-3d63-4444-8e7b-bc938bff7792")
+        async_result.result = {
+            "get_kube_logs": {
+                self.workflow.name: "INFO:root:Time to finish 30.0, 66.6666666667% completed, time steps  left 3.0",
+                "other": "INFO:root:Time to finish 0.0, 100.0% completed, time steps  left 0.0",
+            }
+        }
+
+        # call method
+        self.workflow.update_task_result()
+
+        # check progress changed
+        self.assertEqual(self.workflow.progress, 67.0)
+        self.assertIsNone(self.workflow.task_uuid)
+
+        # Set up: task returned only new lines
+        self.workflow.task_uuid = uuid.UUID("6764743a-3d63-4444-8e7b-bc938bff7792")
+        cluster_log = self.workflow.cluster_log
+        new_lines = "INFO:root:Time to finish 20.0, 77.7777777778% completed, time steps  left 2.0\n"
+        async_result.result = {
+            "get_kube_logs": {self.workflow.name: new_lines},
+            "log_cursors": {self.workflow.name: {"pod": "2021-01-01T12:00:00Z"}},
+        }
+
+        # call method
+        self.workflow.update_task_result()
+
+        # check lines are appended and cursors stored
+        self.assertEqual(self.workflow.cluster_log, cluster_log + new_lines)
+        self.assertEqual(self.workflow.log_cursors, {"pod": "2021-01-01T12:00:00Z"})
+        self.assertEqual(self.workflow.progress, 78.0)
+
+        # and stored as the last chunk of the log history
+        self.assertEqual(self.workflow.log_history(limit=1)[0].text, new_lines)
+
+    def test_log_tail(self):
+        self.workflow.LOG_TAIL_LENGTH = 25
+        for i in range(10):
+            self.workflow._append_log("line {}\n".format(i))
+
+        # the log only keeps its last whole lines, the chunks keep all
+        self.assertEqual(self.workflow.cluster_log, "line 7\nline 8\nline 9\n")
+        self.assertEqual(self.workflow.log_chunks.filter(kind="cluster").count(), 10)
+
+        page = self.workflow.log_history(limit=4)
+        self.assertEqual(page[0].text, "line 9\n")
+        page = self.workflow.log_history(before=page[-1].id, limit=4)
+        self.assertEqual([chunk.text for chunk in page][-1], "line 2\n")
+
     @patch("logging.error", autospec=True)
     def test_update_state_and_save(self, mocked_error_method):
 
@@ -984,7 +1194,10 @@ class WorkflowTestCase(TestCase):
         template_model = self.workflow.scene.scenario.first().template
         with open(template_model.yaml_template.path) as f:
             template = yaml.load(f, Loader=yaml.FullLoader)
-        template["metadata"] = {"name": "{}".format(self.workflow.name)}
+        template["metadata"] = {
+            "name": "{}".format(self.workflow.name),
+            "labels": settings.ARGO_WORKFLOW_LABELS,
+        }
         template["spec"]["arguments"]["parameters"] = [
             {"name": "uuid", "value": str(self.scene_1.suid)},
             {"name": "s3bucket", "value": settings.BUCKETNAME},
@@ -1087,6 +1300,34 @@ class WorkflowTestCase(TestCase):
         self.workflow.update_log()
         self.assertEqual(mocked_task.call_count, 2)
 
+    @patch("delft3dcontainermanager.tasks.get_kube_logs.apply_async", autospec=True)
+    def test_update_logs(self, mocked_task):
+        task_uuid = uuid.UUID("6764743a-3d63-4444-8e7b-bc938bff7792")
+
+        self.workflow.cluster_state = "running"
+        self.workflow.save()
+
+        result = Mock()
+        result.id = task_uuid
+        mocked_task.return_value = result
+
+        # workflows that don't run or have a task get no log
+        exited = Workflow.objects.create(
+            scene=Scene.objects.create(name="exited"), name="exited"
+        )
+        Workflow.update_logs([self.workflow, exited])
+        mocked_task.assert_called_once_with(
+            args=([self.workflow.name],),
+            kwargs={"cursors": {self.workflow.name: {}}},
+            expires=settings.TASK_EXPIRE_TIME,
+        )
+        self.workflow.refresh_from_db()
+        self.assertEqual(self.workflow.task_uuid, task_uuid)
+
+        # a workflow with a task is skipped
+        Workflow.update_logs([self.workflow])
+        self.assertEqual(mocked_task.call_count, 1)
+
     def test_reset_scene(self):
         date_started = now()
         progress = 10
@@ -1,5 +1,9 @@
 from __future__ import absolute_import
 
+import io
+import os
+import tempfile
+import zipfile
 from datetime import date, datetime, time
 
 from django.test import TestCase
@@ -7,9 +11,14 @@ from django.utils import timezone
 
 from delft3dworker.utils import (
     apply_default_tz,
+    delft3d_log_progress,
+    delft3d_logparser,
     log_progress_parser,
     merge_log_unique,
+    scan_output_files,
+    scene_parameter_values,
     tz_midnight,
+    zip_stream,
 )
 
 
@@ -51,6 +60,33 @@ INFO:root:Finished
         progress = log_progress_parser(log, "python")
         self.assertTrue(progress is None)
 
+    def test_delft3d_log_progress(self):
+        """
+        Test if the last progress is found in a long log without parsing
+        every line
+        """
+        lines = [
+            "INFO:root:Time to finish {}, {}% completed".format(100 - i, i)
+            for i in range(100)
+        ]
+        log = "\n".join(lines * 1000 + ["INFO:root:Write netcdf"] * 1000)
+
+        expected = None
+        for line in log.splitlines()[::-1]:
+            expected = delft3d_logparser(line)["progress"]
+            if expected is not None:
+                break
+
+        self.assertEqual(delft3d_log_progress(log), 99.0)
+        self.assertEqual(delft3d_log_progress(log), expected)
+        self.assertEqual(log_progress_parser(log, "delft3d"), expected)
+
+        # first percentage of a line, skipping lines without a number
+        self.assertEqual(delft3d_log_progress("1.5% of 2%\r3%\nabout %"), 3.0)
+        self.assertEqual(delft3d_log_progress("1.5% of 2%\nabout %"), 1.5)
+        self.assertIsNone(delft3d_log_progress("no progress\n%"))
+        self.assertIsNone(delft3d_log_progress(""))
+
 
 class DateTests(TestCase):
     def test_apply_default_tz(self):
@@ -73,3 +109,121 @@ class LogMergeTest(TestCase):
         expected = """1.0%\n2.0%\n3.0%\n4.0%\n5.0%"""
         merged = merge_log_unique(a, b)
         self.assertEqual(merged, expected)
+
+
+class SceneParameterValuesTest(TestCase):
+    def test_scene_parameter_values(self):
+        parameters = {
+            "basinslope": {"value": 0.0143},
+            "composition": {"value": "sand-clay"},
+            "valid": {"value": True},
+            "template": {"values": ["Sandy Gravel"]},
+        }
+        info = {
+            "postprocess_output": {
+                "filetype": "json",
+                "extensions": [".json"],
+                "location": "postprocess/",
+                "files": {"output": {"DeltaTopD50": None, "ProDeltaD50": 0.0718}},
+                "postproc_x": 1,
+            }
+        }
+
+        self.assertEqual(
+            scene_parameter_values(parameters, info),
+            {
+                ("basinslope", "input", 0.0143, None),
+                ("composition", "input", None, "sand-clay"),
+                ("ProDeltaD50", "postprocess", 0.0718, None),
+                ("postproc_x", "postprocess", 1.0, None),
+            },
+        )
+        self.assertEqual(scene_parameter_values({}, {}), set())
+
+
+class ZipStreamTest(TestCase):
+    def test_zip_stream(self):
+        tmpdir = tempfile.mkdtemp()
+        files = []
+        for name, size in [("a.nc", 2500), ("b.png", 10), ("empty.log", 0)]:
+            path = os.path.join(tmpdir, name)
+            with open(path, "wb") as f:
+                f.write(os.urandom(size))
+            files.append((path, os.path.join("scene", name)))
+
+        chunks = list(zip_stream(files, chunk_size=1000))
+
+        # the large file is sent in parts before the archive is complete
+        self.assertGreater(len([c for c in chunks if c]), len(files))
+
+        zf = zipfile.ZipFile(io.BytesIO(b"".join(chunks)))
+        self.assertIsNone(zf.testzip())
+        self.assertEqual(zf.namelist(), [rel_path for _, rel_path in files])
+        for abs_path, rel_path in files:
+            with open(abs_path, "rb") as f:
+                self.assertEqual(zf.read(rel_path), f.read())
+
+
+class ScanOutputFilesTest(TestCase):
+    def setUp(self):
+        self.workingdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.workingdir, "process", "sub"))
+        self.info = {
+            "delta_fringe_images": {
+                "extensions": [".png"],
+                "files": [],
+                "location": "process/",
+            },
+            "postprocess_output": {
+                "extensions": [".json"],
+                "files": {},
+                "location": "process/",
+            },
+        }
+
+    def touch(self, *path, content=""):
+        with open(os.path.join(self.workingdir, "process", *path), "w") as f:
+            f.write(content)
+
+    def age_dirs(self):
+        # directories changed within the mtime resolution are always rescanned
+        for root, dirs, files in os.walk(self.workingdir):
+            os.utime(root, (0, 0))
+
+    def test_incremental_scan(self):
+        self.touch("delta_fringe_1.png", content="png")
+        self.touch("sub", "delta_fringe_0.png")
+        self.touch("output.json", content='{"a": 1}')
+        self.age_dirs()
+
+        index, stats = {}, {}
+        scan_output_files(self.workingdir, self.info, index, stats)
+        self.assertEqual(
+            self.info["delta_fringe_images"]["files"],
+            ["delta_fringe_1.png", "delta_fringe_0.png"],
+        )
+        self.assertEqual(self.info["postprocess_output"]["files"], {"output": {"a": 1}})
+        self.assertEqual(stats, {"dirs": 4, "files": 3, "bytes": 11})
+
+        # unchanged directories are skipped, json directories are listed
+        stats = {}
+        scan_output_files(self.workingdir, self.info, index, stats)
+        self.assertEqual(stats, {"dirs": 2, "files": 0, "bytes": 0})
+
+        # new files and changed json files are processed
+        self.touch("sub", "delta_fringe_2.png")
+        self.touch("output.json", content='{"a": 2}')
+        os.utime(os.path.join(self.workingdir, "process", "output.json"), (1, 1))
+        stats = {}
+        scan_output_files(self.workingdir, self.info, index, stats)
+        self.assertEqual(
+            self.info["delta_fringe_images"]["files"],
+            ["delta_fringe_1.png", "delta_fringe_0.png", "delta_fringe_2.png"],
+        )
+        self.assertEqual(self.info["postprocess_output"]["files"], {"output": {"a": 2}})
+        self.assertEqual(stats["files"], 2)
+
+        # a reset info dict is scanned from scratch
+        self.info["delta_fringe_images"]["files"] = []
+        scan_output_files(self.workingdir, self.info, index)
+        self.assertEqual(len(self.info["delta_fringe_images"]["files"]), 3)
@@ -1,16 +1,32 @@
 from __future__ import absolute_import
 
+import io
+import os
+import shutil
+import tempfile
+import zipfile
 from datetime import datetime
 
+from django.conf import settings
 from django.contrib.auth.models import Group, Permission, User
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from guardian.shortcuts import assign_perm
 from mock import patch
 from rest_framework import status
 from rest_framework.test import APIRequestFactory, APITestCase, force_authenticate
 
-from delft3dworker.models import Scenario, Scene, Template, Workflow
+from delft3dworker.models import (
+    Scenario,
+    Scene,
+    Template,
+    Version_Docker,
+    Workflow,
+    WorkflowLogChunk,
+)
+from delft3dworker.tasks import build_export_archive, create_scenario_scenes
 from delft3dworker.utils import apply_default_tz
 from delft3dworker.views import ScenarioViewSet, SceneViewSet, UserViewSet
 
@@ -713,6 +729,50 @@ class SceneSearchTestCase(TestCase):
         self.assertEqual(len(self._request(search_query_postproc_4)), 2)
         self.assertEqual(len(self._request(search_query_postproc_5)), 1)
 
+    def test_search_params_in_database(self):
+        """
+        Parameter searches are answered by the search table, so the amount
+        of queries does not depend on the number of scenes
+        """
+        query = {"parameter": ["a,2,3", "hack,mud,grease"]}
+        self._request(query)  # log in
+
+        with CaptureQueriesContext(connection) as before:
+            self.assertEqual(len(self._request(query)), 2)
+
+        for i in range(10):
+            scene = Scene.objects.create(
+                name="Testscene extra {}".format(i),
+                owner=self.user_bar,
+                parameters={"a": {"value": i}, "hack": {"value": "sand"}},
+                shared="p",
+            )
+            scene.scenario.add(self.scenario)
+            assign_perm("view_scene", self.user_bar, scene)
+
+        with CaptureQueriesContext(connection) as after:
+            self.assertEqual(len(self._request(query)), 2)
+
+        self.assertEqual(len(before), len(after))
+        self.assertTrue(
+            any(
+                "delft3dworker_sceneparametervalue" in q["sql"]
+                for q in after.captured_queries
+            )
+        )
+
+    def test_search_facets(self):
+        url = reverse("searchform-facets")
+        self.client.login(username="bar", password="secret")
+        facets = self.client.get(url, format="json").data
+
+        self.assertEqual(facets["a"]["min"], 2)
+        self.assertEqual(facets["a"]["max"], 3)
+        self.assertEqual(facets["a"]["count"], 2)
+        self.assertEqual(facets["hack"]["values"], {"mud": 1, "grease": 1})
+        self.assertEqual(facets["postproc_x"]["count"], 2)
+        self.assertEqual(facets["postproc_y"]["count"], 1)
+
     def test_search_user(self):
 
         # user searches
@@ -817,6 +877,297 @@ class SceneSearchTestCase(TestCase):
         return response.data
 
 
+class SceneQueryCountTestCase(APITestCase):
+    """
+    SceneQueryCountTestCase
+    Tests the scene views run a fixed number of queries, whatever the
+    number of scenes
+    """
+
+    def setUp(self):
+        self.user_foo = User.objects.create_user(username="foo", password="secret")
+        self.user_foo.groups.add(Group.objects.create(name="access:foo"))
+        self.user_foo.user_permissions.add(
+            Permission.objects.get(codename="view_scene")
+        )
+        self.template = Template.objects.create(name="Test template")
+        self.version = Version_Docker.objects.create(
+            release="r1", template=self.template
+        )
+        self.scenario = Scenario.objects.create(
+            name="Test scenario", owner=self.user_foo, template=self.template
+        )
+        self.scenes = self._create_scenes(2)
+        self.client.login(username="foo", password="secret")
+
+    def _create_scenes(self, count):
+        scenes = []
+        for i in range(count):
+            scene = Scene.objects.create(
+                name="Scene {}".format(Scene.objects.count()), owner=self.user_foo
+            )
+            scene.scenario.add(self.scenario)
+            Workflow.objects.create(
+                scene=scene, name="wf-{}".format(scene.suid), version=self.version
+            )
+            assign_perm("view_scene", self.user_foo, scene)
+            scenes.append(scene)
+        return scenes
+
+    def _count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(context.captured_queries), response.data
+
+    def test_scene_list_queries(self):
+        url = reverse("scene-list")
+        few, data = self._count_queries(url)
+        self.assertEqual(len(data), 2)
+        self.assertEqual(data[0]["template_name"], "Test template")
+
+        self._create_scenes(10)
+        many, data = self._count_queries(url)
+        self.assertEqual(len(data), 12)
+        self.assertEqual(few, many)
+        self.assertEqual(many, 9)
+
+    def test_scene_detail_queries(self):
+        url = reverse("scene-detail", args=[self.scenes[0].pk])
+        count, data = self._count_queries(url)
+        self.assertEqual(data["template"], "Test template")
+        self.assertEqual(len(data["owner"]["groups"]), 1)
+        self.assertFalse(data["outdated"])
+        self.assertEqual(count, 13)
+
+    def test_scene_conditional_get(self):
+        list_url = reverse("scene-list")
+        detail_url = reverse("scene-detail", args=[self.scenes[0].pk])
+        for url in [list_url, detail_url]:
+            response = self.client.get(url, format="json")
+            etag = response["ETag"]
+
+            # unchanged, so nothing is serialized
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(response["ETag"], etag)
+            self.assertFalse(
+                [q for q in context.captured_queries if "info" in q["sql"]]
+            )
+
+            # a progress update changes the ETag
+            self.scenes[0]._set_progress(self.scenes[0].progress + 1)
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotEqual(response["ETag"], etag)
+
+        # so does a phase shift collected for a bulk update
+        etag = response["ETag"]
+        scene = Scene.objects.get(pk=self.scenes[0].pk)
+        scene.shift_to_phase(Scene.phases.idle, commit=False)
+        Scene.objects.bulk_update([scene], scene.changed_fields)
+        response = self.client.get(detail_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # and a new version of the template, which outdates the scene
+        etag = response["ETag"]
+        Version_Docker.objects.create(release="r2", template=self.template)
+        response = self.client.get(detail_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # scenes not visible are not found, whatever the ETag
+        other = Scene.objects.create(name="Other")
+        url = reverse("scene-detail", args=[other.pk])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_scene_list_pagination(self):
+        url = reverse("scene-list")
+        self._create_scenes(3)
+
+        # without a cursor or page_size the full list is returned
+        count, data = self._count_queries(url)
+        self.assertEqual(len(data), 5)
+
+        # pages follow the id, whatever the requested ordering
+        count, data = self._count_queries(url + "?page_size=2&ordering=-name")
+        ids = list(Scene.objects.order_by("id").values_list("id", flat=True))
+        self.assertEqual([scene["id"] for scene in data["results"]], ids[:2])
+        self.assertEqual(data["count"], 5)
+        self.assertFalse(data["count_estimated"])
+        self.assertIsNone(data["previous"])
+
+        paged = [scene["id"] for scene in data["results"]]
+        while data["next"]:
+            count, data = self._count_queries(data["next"])
+            paged += [scene["id"] for scene in data["results"]]
+        self.assertEqual(paged, ids)
+
+        # the page size is limited
+        with override_settings(API_MAX_PAGE_SIZE=3):
+            count, data = self._count_queries(url + "?page_size=100")
+        self.assertEqual(len(data["results"]), 3)
+
+        # large lists are not counted
+        with override_settings(API_EXACT_COUNT_LIMIT=2):
+            count, data = self._count_queries(url + "?page_size=2")
+        self.assertTrue(data["count_estimated"])
+        self.assertGreaterEqual(data["count"], 3)
+
+        # the ETag of a page follows the scenes on that page
+        etag = self.client.get(url + "?page_size=2")["ETag"]
+        last = Scene.objects.order_by("id").last()
+        last._set_progress(last.progress + 1)
+        response = self.client.get(url + "?page_size=2", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        first = Scene.objects.order_by("id").first()
+        first._set_progress(first.progress + 1)
+        response = self.client.get(url + "?page_size=2", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class SceneLogTestCase(APITestCase):
+    """
+    SceneLogTestCase
+    Tests paging through the workflow log history of a scene
+    """
+
+    def setUp(self):
+        self.user_foo = User.objects.create_user(username="foo", password="secret")
+        self.scene = Scene.objects.create(name="Scene", owner=self.user_foo)
+        assign_perm("view_scene", self.user_foo, self.scene)
+        assign_perm("extended_view_scene", self.user_foo, self.scene)
+
+        workflow = Workflow.objects.create(scene=self.scene, name="scene-log")
+        self.chunks = [
+            WorkflowLogChunk.objects.create(
+                workflow=workflow, text="line {}\n".format(i)
+            )
+            for i in range(3)
+        ]
+        WorkflowLogChunk.objects.create(workflow=workflow, kind="action", text="x")
+
+        self.client.force_authenticate(user=self.user_foo)
+
+    def test_scene_log(self):
+        url = reverse("scene-log", args=[self.scene.pk])
+
+        response = self.client.get(url, {"limit": 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [chunk["text"] for chunk in response.data["results"]],
+            ["line 2\n", "line 1\n"],
+        )
+        self.assertEqual(response.data["next"], self.chunks[1].id)
+
+        response = self.client.get(url, {"limit": 2, "before": response.data["next"]})
+        self.assertEqual(
+            [chunk["text"] for chunk in response.data["results"]], ["line 0\n"]
+        )
+        self.assertIsNone(response.data["next"])
+
+        response = self.client.get(url, {"kind": "action"})
+        self.assertEqual(len(response.data["results"]), 1)
+
+        response = self.client.get(url, {"before": "x"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class SceneExportTestCase(APITestCase):
+    """
+    SceneExportTestCase
+    Tests finished scenes are exported from the archive cache by nginx
+    and other scenes are zipped while streaming
+    """
+
+    def setUp(self):
+        self.filedir = tempfile.mkdtemp()
+        self.filedir_settings = override_settings(WORKER_FILEDIR=self.filedir)
+        self.filedir_settings.enable()
+
+        self.user_foo = User.objects.create_user(username="foo", password="secret")
+        template = Template.objects.create(
+            name="Template",
+            export_options={
+                "export_images": {"extensions": [".png"]},
+                "export_thirdparty": {"extensions": [".gz"], "location": "export"},
+            },
+        )
+        scenario = Scenario.objects.create(name="Scenario", template=template)
+        self.scenes = {}
+        for phase in [Scene.phases.fin, Scene.phases.sim_run]:
+            scene = Scene.objects.create(name="Scene", owner=self.user_foo, phase=phase)
+            scene.scenario.set([scenario])
+            assign_perm("view_scene", self.user_foo, scene)
+            assign_perm("extended_view_scene", self.user_foo, scene)
+            for folder, name in [("process", "image.png"), ("export", "out.gz")]:
+                os.makedirs(os.path.join(scene.workingdir, folder))
+                with open(os.path.join(scene.workingdir, folder, name), "w") as f:
+                    f.write(name)
+            self.scenes[phase] = scene
+
+        self.client.force_authenticate(user=self.user_foo)
+
+    def tearDown(self):
+        self.filedir_settings.disable()
+        shutil.rmtree(self.filedir)
+
+    def _export(self, scene, options):
+        url = reverse("scene-export", args=[scene.pk])
+        return self.client.get(url, {"options": options})
+
+    @patch("delft3dworker.views.build_export_archive", autospec=True)
+    def test_export_finished(self, mocked_task):
+        scene = self.scenes[Scene.phases.fin]
+        options = ["export_images", "export_thirdparty"]
+
+        # the export is streamed while the archive is built outside the request
+        response = self._export(scene, options)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertNotIn("X-Accel-Redirect", response)
+        mocked_task.apply_async.assert_called_once_with(
+            args=(scene.pk, options), expires=settings.TASK_EXPIRE_TIME
+        )
+
+        # and served by nginx once it exists
+        build_export_archive(scene.pk, options)
+        response = self._export(scene, options)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        archive = scene.export_archive_path(options)
+        self.assertEqual(
+            response["X-Accel-Redirect"], "/protected_files/{}".format(archive)
+        )
+        self.assertEqual(
+            response["Content-Disposition"], "attachment; filename=scene.zip"
+        )
+        with zipfile.ZipFile(os.path.join(self.filedir, archive)) as zf:
+            self.assertEqual(
+                sorted(zf.namelist()),
+                ["scene/export/out.gz", "scene/process/image.png"],
+            )
+        self.assertEqual(mocked_task.apply_async.call_count, 1)
+
+        response = self._export(scene, ["export_unknown"])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_streamed(self):
+        scene = self.scenes[Scene.phases.sim_run]
+        response = self._export(scene, ["export_images", "export_thirdparty"])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertNotIn("X-Accel-Redirect", response)
+
+        stream = io.BytesIO(b"".join(response.streaming_content))
+        with zipfile.ZipFile(stream) as zf:
+            self.assertEqual(
+                sorted(zf.namelist()),
+                ["scene/export/out.gz", "scene/process/image.png"],
+            )
+
+
 class ScenarioTestCase(APITestCase):
     """
     ScenarioTestCase
@@ -889,6 +1240,120 @@ class ScenarioTestCase(APITestCase):
         response = self.client.post(url, data, format="json")
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
 
+    @patch("delft3dworker.views.create_scenario_scenes", autospec=True)
+    def test_scenario_post_materializes(self, mocked_task):
+        # scenes of a new scenario are created in the background
+        url = reverse("scenario-list")
+        self.client.login(username="foo", password="secret")
+        data = {
+            "name": "New Sweep",
+            "template": self.template.pk,
+            "parameters": {"basinslope": {"values": [0.01, 0.02, 0.03]}},
+            "scene_set": [],
+        }
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, data, format="json")
+            # the task is only sent once the scenario is committed
+            self.assertEqual(mocked_task.apply_async.call_count, 0)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["state"], Scenario.MATERIALIZING)
+
+        scenario = Scenario.objects.get(name="New Sweep")
+        mocked_task.apply_async.assert_called_once_with(
+            args=(scenario.pk, self.user_foo.pk),
+            queue=settings.SCENARIO_TASK_QUEUE,
+        )
+
+        # poll the progress while materializing
+        url = reverse("scenario-progress", args=[scenario.pk])
+        response = self.client.get(url, format="json")
+        self.assertEqual(
+            response.data,
+            {"state": Scenario.MATERIALIZING, "progress": 0, "scenes": 0, "total": 3},
+        )
+
+        create_scenario_scenes(scenario.pk, self.user_foo.pk)
+        response = self.client.get(url, format="json")
+        self.assertEqual(
+            response.data, {"state": "CREATED", "progress": 0, "scenes": 3, "total": 3}
+        )
+
+        # bar cannot see
+        self.client.login(username="bar", password="secret")
+        response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_scenario_list_read_only(self):
+        # state and progress are summarized from the scenes
+        url = reverse("scenario-list")
+        self.client.login(username="foo", password="secret")
+
+        def get_list():
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url, format="json")
+            self.assertFalse(
+                [q for q in context.captured_queries if q["sql"].startswith("UPDATE")]
+            )
+            return len(context.captured_queries), response.data
+
+        few, data = get_list()
+        self.assertEqual(data[0]["state"], "inactive")
+
+        for i in range(5):
+            scenario = Scenario.objects.create(
+                name="Scenario {}".format(i), owner=self.user_foo
+            )
+            assign_perm("view_scenario", self.user_foo, scenario)
+            for phase, progress in [(Scene.phases.idle, 0), (Scene.phases.sim_run, 50)]:
+                scene = Scene.objects.create(
+                    name="Scene", owner=self.user_foo, phase=phase, progress=progress
+                )
+                scene.scenario.add(scenario)
+
+        many, data = get_list()
+        self.assertEqual(few, many)
+        self.assertEqual(len(data), 6)
+        self.assertEqual(data[-1]["state"], "active")
+        self.assertEqual(data[-1]["progress"], 25)
+        self.assertEqual(len(data[-1]["scene_set"]), 2)
+
+    def test_scenario_conditional_get(self):
+        url = reverse("scenario-detail", args=[self.scenario.pk])
+        self.client.login(username="foo", password="secret")
+        etag = self.client.get(url, format="json")["ETag"]
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # the state of a scenario follows from its scenes
+        scene = Scene.objects.create(name="Scene", owner=self.user_foo)
+        scene.scenario.add(self.scenario)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        etag = response["ETag"]
+        scene.shift_to_phase(Scene.phases.idle)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["state"], "inactive")
+
+        # other scenes with the same summary are told apart, even when
+        # their ids add up to the same total
+        scenes = [
+            Scene.objects.create(name="Scene", owner=self.user_foo) for _ in range(4)
+        ]
+        self.scenario.scene_set.set([scenes[0], scenes[3]])
+        etag = self.client.get(url, format="json")["ETag"]
+        self.scenario.scene_set.set([scenes[1], scenes[2]])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # bar cannot see, not even with the ETag of nothing
+        self.client.login(username="bar", password="secret")
+        etag = self.client.get(reverse("scenario-list"), format="json")["ETag"]
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_scenario_put(self):
         # detail view for PUT (udpate)
         url = reverse("scenario-detail", args=[self.scenario.pk])
@@ -929,6 +1394,58 @@ class ScenarioTestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         mocked_scene_method.assert_called_with(self.scenario, self.user_foo)
 
+    def test_scenario_start_state(self):
+        # the response shows the state after the scenes started
+        url = reverse("scenario-start", args=[self.scenario.pk])
+        self.client.login(username="foo", password="secret")
+
+        def start():
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.put(url, {}, format="json")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data["state"], "active")
+            return len(context.captured_queries)
+
+        def add_scenes(count):
+            for i in range(count):
+                scene = Scene.objects.create(
+                    name="Scene", owner=self.user_foo, phase=Scene.phases.idle
+                )
+                scene.scenario.add(self.scenario)
+                assign_perm("change_scene", self.user_foo, scene)
+
+        add_scenes(1)
+        one = start()
+
+        Scene.objects.update(phase=Scene.phases.idle)
+        add_scenes(2)
+        three = start()
+        # per scene two permission lookups and two saves, no field loads
+        self.assertEqual(three - one, 2 * 4)
+
+    @patch("delft3dworker.models.Scenario.publish_world", autospec=True)
+    @patch("delft3dworker.models.Scenario.publish_company", autospec=True)
+    @patch("delft3dworker.models.Scenario.start", autospec=True)
+    def test_scenario_incomplete_conflict(self, mockStart, mockCompany, mockWorld):
+        # scenarios whose scenes are not all created can't be started or published
+        self.client.login(username="foo", password="secret")
+        requests = [
+            (self.client.put, "scenario-start"),
+            (self.client.post, "scenario-publish-company"),
+            (self.client.post, "scenario-publish-world"),
+        ]
+        for state in [Scenario.MATERIALIZING, Scenario.FAILED]:
+            Scenario.objects.filter(pk=self.scenario.pk).update(state=state)
+            for method, name in requests:
+                url = reverse(name, args=[self.scenario.pk])
+                response = method(url, {}, format="json")
+                self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+                self.assertIn("status", response.data)
+
+        mockStart.assert_not_called()
+        mockCompany.assert_not_called()
+        mockWorld.assert_not_called()
+
 
 class ScenarioSearchTestCase(TestCase):
     """
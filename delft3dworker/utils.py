@@ -1,14 +1,66 @@
 from __future__ import absolute_import
 
+import hashlib
 import json
 import logging
 import os
 import re
 import sys
+import zipfile
 from datetime import datetime, time
+from time import time as timestamp
 
 from django.utils import timezone
 
+# Keys describing a scanned output location in the info dictionary
+SCAN_KEYS = ["filetype", "location", "extensions", "files"]
+
+# Size of the chunks read from disk and sent to the client while zipping
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+# Time in ns within which new files might not change the mtime of a directory
+SCAN_MTIME_RESOLUTION = 2 * 10**9
+
+# Subdirectory of WORKER_FILEDIR with pre-built export archives
+EXPORT_CACHE_DIRNAME = "exports"
+
+# Percentage in a delft3d log line
+DELFT3D_LOG_RE = re.compile(
+    r"""
+    ^(?P<message>.*?        # capture whole string as message
+    (?P<progress>[\d\.]+)%  # capture num with . delim & ending with %
+    .*
+    )
+    """,
+    re.VERBOSE,
+)
+
+# Log level, state and percentage in a python log line
+PYTHON_LOG_RE = re.compile(
+    r"""
+    ^(?P<message>
+        (?P<level>
+            [A-Z]+\w+
+        )?  # capture first capital word as log level
+        .*
+        (?P<state>
+            [A-Z]+\w+
+        )?  # capture second capital word as log state
+        .*
+        (
+            (?P<progress>
+                \d+\.\d+
+            )%
+        )?  # capture num with . delim & ending with %
+        .*
+    )   # capture whole string as message
+    """,
+    re.VERBOSE,
+)
+
+# Percentage as matched by DELFT3D_LOG_RE, without the surrounding groups
+DELFT3D_PROGRESS_RE = re.compile(r"([\d\.]+)%")
+
 
 def tz_now():
     """Return current timezone aware datetime with default timezone
@@ -54,19 +106,40 @@ def derive_defaults_from_argo(argo_yaml):
 
 
 def log_progress_parser(log, container_type):
-    lines = log.splitlines()
     if container_type == "delft3d":
-        for line in lines[::-1]:
-            parsed = delft3d_logparser(line)
-            if parsed["progress"] is not None:
-                return parsed["progress"]
+        return delft3d_log_progress(log)
     else:  # TODO: improve method to raise error if type is unknown
-        for line in lines[::-1]:
+        for line in log.splitlines()[::-1]:
             parsed = python_logparser(line)
             if parsed["progress"] is not None:
                 return parsed["progress"]
 
 
+def delft3d_log_progress(log):
+    """
+    Return the progress of the last delft3d log line reporting one.
+
+    Only lines containing a % are parsed, walking back from the end
+    of the log, so a long log is not split into lines.
+    :param log: delft3d log
+    :return: progress [0-100] or None
+    """
+    end = len(log)
+    while True:
+        percent = log.rfind("%", 0, end)
+        if percent < 0:
+            return None
+        start = max(log.rfind("\n", 0, percent), log.rfind("\r", 0, percent)) + 1
+        # the first percentage of a line is its progress
+        match = DELFT3D_PROGRESS_RE.search(log, start, percent + 1)
+        if match is not None:
+            try:
+                return float(match.group(1))
+            except ValueError:
+                pass
+        end = start
+
+
 def delft3d_logparser(line):
     """
     read progress information from delft3d log.
@@ -76,17 +149,7 @@ def delft3d_logparser(line):
 
     try:
 
-        percentage_re = re.compile(
-            r"""
-        ^(?P<message>.*?        # capture whole string as message
-        (?P<progress>[\d\.]+)%  # capture num with . delim & ending with %
-        .*
-        )
-        """,
-            re.VERBOSE,
-        )
-        match = percentage_re.search(line)
-
+        match = DELFT3D_LOG_RE.search(line)
         if match:
             match = match.groupdict()
             match["message"] = line
@@ -126,29 +189,7 @@ def python_logparser(line):
 
     try:
 
-        python_re = re.compile(
-            r"""
-        ^(?P<message>
-            (?P<level>
-                [A-Z]+\w+
-            )?  # capture first capital word as log level
-            .*
-            (?P<state>
-                [A-Z]+\w+
-            )?  # capture second capital word as log state
-            .*
-            (
-                (?P<progress>
-                    \d+\.\d+
-                )%
-            )?  # capture num with . delim & ending with %
-            .*
-        )   # capture whole string as message
-        """,
-            re.VERBOSE,
-        )
-        match = python_re.search(line)
-
+        match = PYTHON_LOG_RE.search(line)
         if match:
             match = match.groupdict()
             if (
@@ -173,7 +214,7 @@ def python_logparser(line):
         }
 
 
-def scan_output_files(workingdir, info_dict):
+def scan_output_files(workingdir, info_dict, index=None, stats=None):
     """
     Scans a working directory for files as specified in the structure of the dictionary.
     using the first key as a search key, a subkey of "location" as the subdirectory,
@@ -183,8 +224,18 @@ def scan_output_files(workingdir, info_dict):
     :param dict: dictionary containing information about what files to search for. See
     delft3d-gt-server/delft3dworker/fixtures/default_template_v3.json, key "info", for
     an example of structure.
+    :param index: scan index of a previous call, updated in place. Directories that
+    did not change since then are not listed again and json files are only parsed
+    again when they changed.
+    :param stats: dictionary to which the number of scanned directories and the
+    number and size of processed files are added.
     :return: dict: now with files subkey list filled for each key
     """
+    index = {} if index is None else index
+    stats = {} if stats is None else stats
+    for counter in ("dirs", "files", "bytes"):
+        stats.setdefault(counter, 0)
+
     processed_files = 0
     required_keys = ["location", "extensions", "files"]
     for key, value in info_dict.items():
@@ -197,10 +248,26 @@ def scan_output_files(workingdir, info_dict):
         if not all([k in value for k in required_keys]):
             continue
 
+        # Start over when files were removed from the info dict (reset)
+        key_index = index.get(key)
+        if key_index is None or len(value["files"]) < key_index["count"]:
+            key_index = {"count": 0, "dirs": {}, "mtimes": {}}
+            index[key] = key_index
+
+        # json files can be rewritten in place, which does not
+        # change the mtime of their directory, so always list those
+        is_json = ".json" in value["extensions"]
+        seen = set(value["files"])
+
         foldername = os.path.join(workingdir, value["location"])
-        for root, __, files in os.walk(foldername):
+        for root, entries in _scan_dirs(
+            foldername, key_index["dirs"], skip_unchanged=not is_json
+        ):
+            stats["dirs"] += 1
+
             # sort to correctly order images
-            for fn in sorted(files):
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                fn = entry.name
                 name, ext = os.path.splitext(fn)
 
                 # Check if we use this file
@@ -208,10 +275,16 @@ def scan_output_files(workingdir, info_dict):
                     continue
 
                 # and if we already have it
-                if fn in value["files"]:
+                if ".json" in ext:
+                    mtime = entry.stat().st_mtime_ns
+                    if key_index["mtimes"].get(fn) == mtime:
+                        continue
+                    key_index["mtimes"][fn] = mtime
+                elif fn in seen:
                     continue
 
                 processed_files += 1
+                stats["bytes"] += entry.stat().st_size
 
                 # If images, search by key
                 # TODO Use regex expressions in the future
@@ -219,6 +292,7 @@ def scan_output_files(workingdir, info_dict):
                     type_of_image = key.split("_images")[0]
                     if type_of_image in name:
                         info_dict[key]["files"].append(fn)
+                        seen.add(fn)
 
                 # If json, use filename as key and load json
                 elif ".json" in ext:
@@ -235,13 +309,224 @@ def scan_output_files(workingdir, info_dict):
                 # Add files without parsing
                 else:
                     info_dict[key]["files"].append(fn)
+                    seen.add(fn)
+
+        key_index["count"] = len(value["files"])
 
-        if processed_files > 0:
-            logging.info("Processed {} files.".format(processed_files))
+    stats["files"] += processed_files
+    if processed_files > 0:
+        logging.info(
+            "Processed {} files ({} bytes).".format(processed_files, stats["bytes"])
+        )
 
     return info_dict
 
 
+def _scan_dirs(top, dirs_index, skip_unchanged=True):
+    """
+    Walk the directory tree below top and yield (directory, file entries) for
+    each directory that changed since the last walk. The mtime and subdirectories
+    of each directory are kept in dirs_index, by path relative to top.
+    """
+    # Directories modified this recently might still get files within
+    # the resolution of their mtime, so these are listed again next time
+    recent = int(timestamp() * 10**9) - SCAN_MTIME_RESOLUTION
+
+    stack = [top]
+    while stack:
+        path = stack.pop()
+        relpath = os.path.relpath(path, top)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            dirs_index.pop(relpath, None)
+            continue
+
+        known = dirs_index.get(relpath)
+        if skip_unchanged and known is not None and known[0] == mtime:
+            stack.extend(os.path.join(top, d) for d in reversed(known[1]))
+            continue
+
+        files, subdirs = [], []
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    subdirs.append(entry.path)
+                else:
+                    files.append(entry)
+
+        subdirs.sort()
+        dirs_index[relpath] = [
+            mtime if mtime < recent else None,
+            [os.path.relpath(d, top) for d in subdirs],
+        ]
+        stack.extend(reversed(subdirs))
+        yield path, files
+
+
+def output_fingerprint(workingdir, info_dict):
+    """
+    Fingerprint of the output locations in the info dictionary: the number of
+    files, their total size and latest mtime per location. Files are only
+    listed and not read, so this is cheaper than a scan.
+    :param workingdir: The working directory, where output directories/files are saved
+    :param info_dict: dictionary with the locations to scan, see scan_output_files
+    :return: sha1 hex digest
+    """
+    locations = set(
+        value["location"]
+        for value in info_dict.values()
+        if isinstance(value, dict) and "location" in value
+    )
+
+    fingerprint = hashlib.sha1()
+    for location in sorted(locations):
+        count, size, mtime = 0, 0, 0
+        for root, dirs, files in os.walk(os.path.join(workingdir, location)):
+            for fn in files:
+                try:
+                    stat = os.stat(os.path.join(root, fn))
+                except OSError:
+                    continue  # removed while walking
+                count += 1
+                size += stat.st_size
+                mtime = max(mtime, stat.st_mtime_ns)
+        fingerprint.update(
+            "{}:{}:{}:{}\n".format(location, count, size, mtime).encode("utf-8")
+        )
+
+    return fingerprint.hexdigest()
+
+
+def scene_parameter_values(parameters, info):
+    """
+    Collect the searchable values of a scene: the value of each input
+    parameter and the scalar postprocessing output. Values are returned
+    as (key, source, numeric value, text value) tuples, so they can be
+    compared with the rows of the SceneParameterValue table.
+    :param parameters: the parameters dictionary of a scene
+    :param info: the info dictionary of a scene
+    :return: set of (key, source, numeric_value, text_value) tuples
+    """
+    values = set()
+
+    def add(key, source, value):
+        # bools are ints in Python, but neither numeric nor text in json
+        if isinstance(value, bool):
+            return
+        if isinstance(value, (int, float)):
+            if float("-inf") < value < float("inf"):
+                values.add((key, source, float(value), None))
+        elif isinstance(value, str) and len(value) <= 256:  # fits the column
+            values.add((key, source, None, value))
+
+    for key, parameter in (parameters or {}).items():
+        if isinstance(parameter, dict):
+            add(key, "input", parameter.get("value"))
+
+    # output is either stored directly or per parsed json file
+    postprocess_output = (info or {}).get("postprocess_output")
+    if isinstance(postprocess_output, dict):
+        for key, value in postprocess_output.items():
+            if key not in SCAN_KEYS:
+                add(key, "postprocess", value)
+
+        files = postprocess_output.get("files")
+        if isinstance(files, dict):
+            for output in files.values():
+                if isinstance(output, dict):
+                    for key, value in output.items():
+                        add(key, "postprocess", value)
+
+    return values
+
+
+class _ZipStreamBuffer(object):
+    """Unseekable file-like object collecting the bytes written by ZipFile."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def zip_stream(files, chunk_size=ZIP_CHUNK_SIZE):
+    """Yield an uncompressed zip archive of the given files in chunks.
+
+    The archive is written to an unseekable buffer, so each file is read
+    and sent in chunks of chunk_size and memory use does not depend on the
+    size of the files.
+    :param files: iterable of (absolute path, path in archive) tuples
+    :param chunk_size: number of bytes to read from a file at once
+    :return: generator of bytes
+    """
+    buffer = _ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED, True) as zf:
+        for abs_path, rel_path in files:
+            zinfo = zipfile.ZipInfo.from_file(abs_path, rel_path)
+            zinfo.compress_type = zipfile.ZIP_STORED
+            with open(abs_path, "rb") as src, zf.open(zinfo, "w") as dest:
+                for chunk in iter(lambda: src.read(chunk_size), b""):
+                    dest.write(chunk)
+                    yield buffer.pop()
+            yield buffer.pop()
+    yield buffer.pop()
+
+
+def export_archive_name(suid, options, files):
+    """Name of the export archive of a scene for the given options and files.
+
+    The name holds a hash of the options and a hash of the paths, sizes and
+    modification times of the files, so an archive is rebuilt when its files
+    change and archives of other options of the same scene can be found.
+    :param suid: suid of the scene
+    :param options: list of export options
+    :param files: list of (absolute path, path in archive) tuples
+    :return: file name of the archive
+    """
+    options_hash = hashlib.sha1(
+        ",".join(sorted(set(options))).encode("utf-8")
+    ).hexdigest()[:12]
+
+    files_hash = hashlib.sha1()
+    for abs_path, rel_path in files:
+        stat = os.stat(abs_path)
+        files_hash.update(
+            "{}:{}:{}\n".format(rel_path, stat.st_size, stat.st_mtime_ns).encode(
+                "utf-8"
+            )
+        )
+
+    return "{}-{}-{}.zip".format(suid, options_hash, files_hash.hexdigest()[:12])
+
+
+def write_zip(files, path):
+    """Write a zip archive of the given files to path.
+
+    The archive is written to a temporary file first, so a partly written
+    archive is never served.
+    """
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp_path, "wb") as f:
+            for chunk in zip_stream(files):
+                f.write(chunk)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 def clean(jsondict):
     """Remove invalid JSON values from dict.
     Invalid values are -inf, nan, inf
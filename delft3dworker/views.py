@@ -3,17 +3,23 @@ Views for the ui.
 """
 from __future__ import absolute_import
 
-import io
+import hashlib
 import logging
-import zipfile
+import os
 from datetime import timedelta
+from functools import partial
 
 import django_filters
+from django.conf import settings
 from django.contrib.auth.models import Group, User
+from django.contrib.postgres.aggregates import ArrayAgg
 from django.core.exceptions import ValidationError
-from django.http import HttpResponse
+from django.db import transaction
+from django.db.models import OuterRef, Prefetch, Subquery
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils.dateparse import parse_date
+from django.utils.http import parse_etags, quote_etag
 from django.utils.text import slugify
 from django_filters import rest_framework as e_filters
 from guardian.shortcuts import assign_perm, get_objects_for_user
@@ -23,7 +29,9 @@ from rest_framework.response import Response
 from rest_framework_guardian import filters as guardian_filter
 
 from delft3dworker.models import Scenario, Scene, SearchForm, Template, Version_Docker
+from delft3dworker.pagination import EstimatedCountCursorPagination
 from delft3dworker.permissions import ExtendedScenePermission, ViewObjectPermissions
+from delft3dworker.search import filter_scenes_by_parameters, parameter_facets
 from delft3dworker.serializers import (
     GroupSerializer,
     ScenarioSerializer,
@@ -33,8 +41,10 @@ from delft3dworker.serializers import (
     TemplateSerializer,
     UserSerializer,
     VersionSerializer,
+    WorkflowLogChunkSerializer,
 )
-from delft3dworker.utils import tz_midnight
+from delft3dworker.tasks import build_export_archive, create_scenario_scenes
+from delft3dworker.utils import tz_midnight, zip_stream
 
 # ################################### REST
 
@@ -69,15 +79,118 @@ class SceneFilter(e_filters.FilterSet):
         fields = ["name", "state", "scenario"]
 
 
+# ### Mixins
+
+
+class ConditionalGetMixin(object):
+    """
+    Answers list and detail GET requests with an ETag of the version stamps
+    of the objects involved, and with 304 Not Modified, without serializing,
+    when the If-None-Match header holds that ETag.
+    """
+
+    # Values that change when the serialized object changes
+    etag_fields = ("id", "stamp")
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+
+        # as ListModelMixin.list, on the queryset filtered once
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            # only the returned page and its links make up the ETag
+            etag = self.get_etag(
+                queryset.model.objects.filter(pk__in=[obj.pk for obj in page]),
+                self.get_paginated_response([]).data,
+            )
+        else:
+            etag = self.get_etag(queryset)
+        if self._not_modified(request, etag):
+            return self._not_modified_response(etag)
+
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            response = self.get_paginated_response(serializer.data)
+        else:
+            serializer = self.get_serializer(queryset, many=True)
+            response = Response(serializer.data)
+        return self._tag(response, etag)
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        queryset = self.filter_queryset(self.get_queryset()).filter(
+            **{self.lookup_field: kwargs[lookup_url_kwarg]}
+        )
+        etag = self.get_etag(queryset)
+        if self._not_modified(request, etag):
+            # permissions may have changed since the client got its copy
+            instance = get_object_or_404(self._stamped(queryset).only("pk"))
+            self.check_object_permissions(request, instance)
+            return self._not_modified_response(etag)
+
+        # as GenericAPIView.get_object, on the queryset filtered once
+        instance = get_object_or_404(queryset)
+        self.check_object_permissions(request, instance)
+        serializer = self.get_serializer(instance)
+        return self._tag(Response(serializer.data), etag)
+
+    def get_etag(self, queryset, *extra):
+        """
+        Return the quoted ETag of the objects in the queryset, and of any
+        extra values that end up in the response.
+        """
+        values = (
+            self.get_etag_queryset(queryset)
+            .values_list(*self.etag_fields)
+            .order_by(*self.etag_fields)
+        )
+        tag = str([list(values)] + list(extra))
+        return quote_etag(hashlib.md5(tag.encode("utf-8")).hexdigest())
+
+    def get_etag_queryset(self, queryset):
+        """
+        Return the queryset to read the etag_fields from, a single row per
+        object.
+        """
+        return self._stamped(queryset)
+
+    def _stamped(self, queryset):
+        # a plain queryset, free of the annotations and prefetches of the view
+        return queryset.model.objects.filter(pk__in=queryset.values("pk"))
+
+    def _not_modified(self, request, etag):
+        etags = parse_etags(request.META.get("HTTP_IF_NONE_MATCH", ""))
+        return etag in [tag[2:] if tag.startswith("W/") else tag for tag in etags]
+
+    def _not_modified_response(self, etag):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+    def _tag(self, response, etag):
+        if response.status_code == status.HTTP_200_OK:
+            response["ETag"] = etag
+        return response
+
+
 # ### ViewSets
 
 
-class ScenarioViewSet(viewsets.ModelViewSet):
+class ScenarioViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows scenarios to be viewed or edited.
     """
 
     serializer_class = ScenarioSerializer
+
+    # state, progress and scene_set follow from the scenes
+    etag_fields = (
+        "id",
+        "stamp",
+        "scene_count",
+        "scenes_active",
+        "scene_progress",
+        "scene_ids",
+    )
+
     filter_backends = (
         django_filters.rest_framework.DjangoFilterBackend,
         filters.SearchFilter,
@@ -93,6 +206,9 @@ class ScenarioViewSet(viewsets.ModelViewSet):
     # reverse by setting ('-id',)
     ordering = ("id",)
 
+    # Paginated on request with ?page_size= and ?cursor=
+    pagination_class = EstimatedCountCursorPagination
+
     # Our own custom filter to create custom search fields
     # this creates &name= among others
     filterset_class = ScenarioFilter
@@ -101,6 +217,14 @@ class ScenarioViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         queryset = Scenario.objects.all()
+
+        # state, progress and scene ids of the serialized scenarios follow
+        # from the scenes. Actions change the scenes, so they are left to
+        # summarize them afterwards.
+        if self.action in ("list", "retrieve"):
+            queryset = Scenario.with_scene_summary(queryset).prefetch_related(
+                Prefetch("scene_set", queryset=Scene.objects.only("id"))
+            )
         return queryset.order_by("name")
 
     def perform_create(self, serializer):
@@ -117,8 +241,8 @@ class ScenarioViewSet(viewsets.ModelViewSet):
             if parameters:
                 # we're adding the template to the parameters
                 parameters["template"] = {"values": [instance.template.name]}
+                instance.state = Scenario.MATERIALIZING
                 instance.load_settings(parameters)
-                instance.createscenes(self.request.user)
 
             assign_perm("add_scenario", self.request.user, instance)
             assign_perm("change_scenario", self.request.user, instance)
@@ -127,13 +251,47 @@ class ScenarioViewSet(viewsets.ModelViewSet):
 
             instance.save()
 
+            # the scenes are created in the background, poll progress
+            if parameters:
+                transaction.on_commit(
+                    partial(
+                        create_scenario_scenes.apply_async,
+                        args=(instance.pk, self.request.user.pk),
+                        queue=settings.SCENARIO_TASK_QUEUE,
+                    )
+                )
+
+    def get_etag_queryset(self, queryset):
+        # the scene summary rather than every scene of every scenario
+        queryset = super(ScenarioViewSet, self).get_etag_queryset(queryset)
+        return Scenario.with_scene_summary(queryset).annotate(
+            scene_ids=ArrayAgg("scene", ordering="scene")
+        )
+
     # Pass on user to check permissions
     def perform_destroy(self, instance):
         instance.delete(self.request.user)
 
+    def _incomplete(self, scenario):
+        """
+        Return a 409 response if the scenes of the scenario are still being
+        created, or failed to be, None otherwise.
+        """
+        if scenario.state == Scenario.MATERIALIZING:
+            message = "Scenes of this scenario are still being created"
+        elif scenario.state == Scenario.FAILED:
+            message = "Creating the scenes of this scenario failed"
+        else:
+            return None
+        return Response({"status": message}, status=status.HTTP_409_CONFLICT)
+
     @action(methods=["put"], detail=True)  # denied after publish to company/world
     def start(self, request, pk=None):
         scenario = self.get_object()
+        incomplete = self._incomplete(scenario)
+        if incomplete is not None:
+            return incomplete
+
         scenario.start(request.user)
         serializer = self.get_serializer(scenario)
 
@@ -149,23 +307,59 @@ class ScenarioViewSet(viewsets.ModelViewSet):
 
         return Response(serializer.data)
 
+    @action(methods=["get"], detail=True)
+    def progress(self, request, pk=None):
+        """
+        Return the state and progress of a scenario, which shows how many
+        scenes are created while it is MATERIALIZING.
+        """
+        scenario = self.get_object()
+        return Response(
+            {
+                "state": scenario.state,
+                "progress": scenario.progress,
+                "scenes": scenario.scene_set.count(),
+                "total": len(scenario.scenes_parameters),
+            }
+        )
+
     @action(methods=["post"], detail=True)  # denied after publish to world
     def publish_company(self, request, pk=None):
-        self.get_object().publish_company(request.user)
+        scenario = self.get_object()
+        incomplete = self._incomplete(scenario)
+        if incomplete is not None:
+            return incomplete
+
+        scenario.publish_company(request.user)
         return Response({"status": "Published scenario to company"})
 
     @action(methods=["post"], detail=True)  # denied after publish to world
     def publish_world(self, request, pk=None):
-        self.get_object().publish_world(request.user)
+        scenario = self.get_object()
+        incomplete = self._incomplete(scenario)
+        if incomplete is not None:
+            return incomplete
+
+        scenario.publish_world(request.user)
         return Response({"status": "Published scenario to world"})
 
 
-class SceneViewSet(viewsets.ModelViewSet):
+class SceneViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows scenes to be viewed or edited.
     """
 
     serializer_class = SceneSparseSerializer
+
+    # the template name and outdated flag follow from the template
+    etag_fields = (
+        "id",
+        "stamp",
+        "scenario__template__stamp",
+        "workflow__version",
+        "latest_version",
+    )
+
     filter_backends = (
         django_filters.rest_framework.DjangoFilterBackend,
         filters.SearchFilter,
@@ -175,6 +369,9 @@ class SceneViewSet(viewsets.ModelViewSet):
     # Default order by name, so runs don't jump around
     ordering = ("id",)
 
+    # Paginated on request with ?page_size= and ?cursor=
+    pagination_class = EstimatedCountCursorPagination
+
     # Our own custom filter to create custom search fields
     # this creates &template= among others
     filterset_class = SceneFilter
@@ -191,6 +388,17 @@ class SceneViewSet(viewsets.ModelViewSet):
     # If we overwrite get queryset
     queryset = Scene.objects.none()
 
+    def get_etag_queryset(self, queryset):
+        # the latest version of the template, rather than all its versions
+        queryset = super(SceneViewSet, self).get_etag_queryset(queryset)
+        return queryset.annotate(
+            latest_version=Subquery(
+                Version_Docker.objects.filter(
+                    template=OuterRef("scenario__template")
+                ).values("revision")[:1]
+            )
+        )
+
     def get_serializer_class(self):
         """Override serializer for lite list."""
         if self.action == "list":
@@ -223,7 +431,8 @@ class SceneViewSet(viewsets.ModelViewSet):
             # filters on key occurance and value between min & max
             - parameter="parameter,minvalue,maxvalue"
 
-            TODO: This method needs to be rewritten, badly
+        Parameter filters are evaluated by the database,
+        see `delft3dworker.search`.
         """
         queryset = Scene.objects.all()
 
@@ -239,100 +448,11 @@ class SceneViewSet(viewsets.ModelViewSet):
         started_after = self.request.query_params.get("started_after", "")
         started_before = self.request.query_params.get("started_before", "")
 
-        # explained later
-        temp_workaround = False
-
         if len(parameters) > 0:
             # Processing user input
             # will sometimes fail
             try:
-                for parameter in parameters:
-
-                    p = parameter.split(",")
-                    p = [val for val in p if val != ""]
-
-                    # Key, min, max lookup
-                    if len(p) == 3:
-
-                        key, minvalue, maxvalue = p
-                        logging.info(
-                            "Lookup value [{} - {}] for parameter {}".format(
-                                minvalue, maxvalue, key
-                            )
-                        )
-
-                        try:
-                            # Find integers or floats
-                            minvalue = float(minvalue)
-                            maxvalue = float(maxvalue)
-
-                            # Create json lookup
-                            # q = {key: {'value': value}}
-
-                            # Not yet possible to do json queries directly
-                            # Requires JSONField from Postgresql 9.4 and Django
-                            # 1.9 So we loop manually (bad performance!)
-                            wanted = []
-                            for scene in queryset:
-
-                                # filter on input parameters
-                                value = scene.parameters.get(key, {}).get(
-                                    "value", "None"
-                                )
-                                if (value != "None") and (
-                                    minvalue <= value <= maxvalue
-                                ):
-                                    wanted.append(scene.id)
-
-                                # filter on postprocessing output
-                                postprocess_output = scene.info.get(
-                                    "postprocess_output"
-                                )
-
-                                if key in postprocess_output:
-                                    value = postprocess_output[key]
-                                    if minvalue <= value <= maxvalue:
-                                        wanted.append(scene.id)
-
-                            queryset = queryset.filter(pk__in=wanted)
-
-                        except ValueError:
-                            pass  # no floats? no results
-                            temp_workaround = True
-
-                    # The front-end is supposed to provide sediment
-                    # compositions as follows:
-                    #
-                    # ...?parameter=composition,sand-clay&parameter=composition,mud
-                    #
-                    # however, now it provides it as follows:
-                    #
-                    # ...?parameter=composition,sand-clay,mud
-                    #
-                    # hence this temp_workaround:
-                    if temp_workaround or len(p) == 2 or len(p) > 3:
-                        key = p[0]
-                        values = p[1:]
-                        wanted = []
-
-                        queryset = queryset.filter(parameters__icontains=key)
-
-                        for value in values:
-
-                            # a blatant copy-paste of the above, because I
-                            # cannot be bothered
-
-                            logging.info("Lookup value for parameter {}".format(key))
-
-                            for scene in queryset:
-                                if (
-                                    scene.parameters.get(key, {}).get("value", "")
-                                    == value
-                                ):
-                                    wanted.append(scene.id)
-
-                        queryset = queryset.filter(pk__in=wanted)
-
+                queryset = filter_scenes_by_parameters(queryset, parameters)
             except Exception as e:
                 logging.exception(
                     "Search with params {} and template {} failed".format(
@@ -380,6 +500,16 @@ class SceneViewSet(viewsets.ModelViewSet):
                 dt = tz_midnight(started_before_date + timedelta(days=1))
                 queryset = queryset.filter(date_started__lte=dt)
 
+        # load the related objects of all serialized scenes at once,
+        # the sparse list only shows the template name
+        if self.action == "list":
+            queryset = queryset.prefetch_related("scenario__template")
+        else:
+            queryset = queryset.select_related("owner", "workflow__version")
+            queryset = queryset.prefetch_related(
+                "scenario__template__versions", "owner__groups"
+            )
+
         return queryset.distinct().order_by("name")
 
     @action(detail=True, methods=["put"])  # denied after publish to company/world
@@ -432,6 +562,43 @@ class SceneViewSet(viewsets.ModelViewSet):
 
         return Response(serializer.data)
 
+    @action(
+        methods=["get"],
+        detail=True,
+        permission_classes=[permissions.IsAuthenticated, ExtendedScenePermission],
+    )
+    def log(self, request, pk=None):
+        """
+        Page through the log history of the workflow of a scene, newest
+        first. Query parameters: kind (cluster or action), before (id of
+        the last chunk of the previous page) and limit.
+        """
+        scene = self.get_object()
+        if not hasattr(scene, "workflow"):
+            return Response({"results": [], "next": None})
+
+        try:
+            before = request.query_params.get("before")
+            before = int(before) if before is not None else None
+            limit = max(1, min(int(request.query_params.get("limit", 50)), 500))
+        except ValueError:
+            return Response(
+                {"status": "Invalid before or limit"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        chunks = scene.workflow.log_history(
+            kind=request.query_params.get("kind", "cluster"),
+            before=before,
+            limit=limit,
+        )
+        return Response(
+            {
+                "results": WorkflowLogChunkSerializer(chunks, many=True).data,
+                "next": chunks[-1].id if len(chunks) == limit else None,
+            }
+        )
+
     @action(methods=["post"], detail=True)  # denied after publish to world
     def publish_company(self, request, pk=None):
         published = self.get_object().publish_company(request.user)
@@ -505,27 +672,42 @@ class SceneViewSet(viewsets.ModelViewSet):
             )
 
         scene = self.get_object()
+        filename = "{}.zip".format(slugify(scene.name))
+
+        # Finished scenes don't change, so their archive is built once
+        # and served by nginx from then on
+        if scene.phase == scene.phases.fin:
+            archive = scene.export_archive_path(options)
+            if archive is not None and os.path.exists(
+                os.path.join(settings.WORKER_FILEDIR, archive)
+            ):
+                resp = HttpResponse(content_type="application/x-zip-compressed")
+                resp["X-Accel-Redirect"] = "/protected_files/{}".format(archive)
+                resp["Content-Disposition"] = "attachment; filename={}".format(filename)
+                return resp
+
+            # zipping takes long, so the archive is built outside the
+            # request while this one is streamed
+            if archive is not None:
+                build_export_archive.apply_async(
+                    args=(scene.pk, options), expires=settings.TASK_EXPIRE_TIME
+                )
 
-        # The zip compressor
-        # Open BytesIO to grab in-memory ZIP contents
-        # (be explicit about bytes)
-        stream = io.BytesIO()
-        zf = zipfile.ZipFile(stream, "w", zipfile.ZIP_STORED, True)
-        files_added = scene.export(zf, options)
-        zf.close()
+        # Collect the files first, so an empty export can still be refused
+        files = list(scene.export_files(options))
 
-        if not files_added:
+        if not files:
             return Response(
                 {"status": "Empty zip file: selected files do not exist"},
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        resp = HttpResponse(
-            stream.getvalue(), content_type="application/x-zip-compressed"
-        )
-        resp["Content-Disposition"] = "attachment; filename={}".format(
-            "{}.zip".format(slugify(scene.name))
+        # The zip is streamed while it is written, so large
+        # files are never held in memory
+        resp = StreamingHttpResponse(
+            zip_stream(files), content_type="application/x-zip-compressed"
         )
+        resp["Content-Disposition"] = "attachment; filename={}".format(filename)
 
         return resp
 
@@ -554,6 +736,7 @@ class SceneViewSet(viewsets.ModelViewSet):
             "delft3dworker.extended_view_scene",
             accept_global_perms=False,
         ).filter(suid__in=request.query_params.getlist("suid", []))
+        queryset = queryset.prefetch_related("scenario__template")
         if len(queryset) == 0:
             return Response(
                 {
@@ -562,24 +745,17 @@ class SceneViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        # The zip compressor
-        # Open BytesIO to grab in-memory ZIP contents
-        # (be explicit about bytes)
-        stream = io.BytesIO()
-        zf = zipfile.ZipFile(stream, "w", zipfile.ZIP_STORED, True)
-        files_added = False
-        for scene in queryset:
-            files_added = scene.export(zf, options) or files_added
-        zf.close()
-
-        if not files_added:
+        # Collect the files first, so an empty export can still be refused
+        files = [f for scene in queryset for f in scene.export_files(options)]
+
+        if not files:
             return Response(
                 {"status": "Empty zip file: selected files do not exist"},
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        resp = HttpResponse(
-            stream.getvalue(), content_type="application/x-zip-compressed"
+        resp = StreamingHttpResponse(
+            zip_stream(files), content_type="application/x-zip-compressed"
         )
         resp["Content-Disposition"] = "attachment; filename=Delft3DGTFiles.zip"
         return resp
@@ -589,7 +765,7 @@ class SceneViewSet(viewsets.ModelViewSet):
         return Response({})
 
 
-class SearchFormViewSet(viewsets.ModelViewSet):
+class SearchFormViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows search forms to be viewed.
     """
@@ -600,8 +776,16 @@ class SearchFormViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         return SearchForm.objects.filter(name="MAIN")
 
+    @action(methods=["get"], detail=False)
+    def facets(self, request):
+        # ranges and value counts of the scenes visible to this user
+        scenes = get_objects_for_user(
+            request.user, "delft3dworker.view_scene", accept_global_perms=False
+        )
+        return Response(parameter_facets(scenes))
+
 
-class TemplateViewSet(viewsets.ModelViewSet):
+class TemplateViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows templates to be viewed or edited.
     """